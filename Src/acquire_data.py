@@ -8,53 +8,250 @@ Website: https://www.livetheaiexperience.com/
 """
 
 import urllib.request
+import urllib.error
 import os
+import hashlib
+import http.client
+import socket
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 import click
 import time
 
-def download_images(link_file_images, output_directory, image_type):
+CHUNK_SIZE = 1 << 20
+
+# HTTP errors that are worth retrying, any other error status fails the file straight away.
+RETRY_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+
+def read_checksums(checksum_file):
+	"""
+	Reads a checksum file in the format written by md5sum or sha256sum ("<hex digest>  <filename>").
+
+	Returns
+	----------
+	> A dictionary mapping file names to hex digests.
+	"""
+
+	checksums = {}
+	with open(checksum_file, 'r') as checksum_lines:
+		for line in checksum_lines:
+			if line.strip():
+				digest, filename = line.split(None, 1)
+				checksums[os.path.basename(filename.strip().lstrip('*'))] = digest.lower()
+	return checksums
+
+
+def file_digest(path, digest):
 	"""
-	Reads a file with links to the images, and downloads them to the specified location.
+	Computes the md5 or sha256 digest of a file, chosen from the length of the expected digest.
+	"""
+
+	hasher = hashlib.md5() if len(digest) == 32 else hashlib.sha256()
+	with open(path, 'rb') as f:
+		for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+			hasher.update(chunk)
+	return hasher.hexdigest()
+
+
+def remote_size(url, timeout):
+	"""
+	Size of a remote file from the Content-Length of a HEAD request, or None if the server does not send it.
+	"""
+
+	request = urllib.request.Request(url, method='HEAD')
+	with urllib.request.urlopen(request, timeout=timeout) as response:
+		length = response.headers.get('Content-Length')
+	return int(length) if length is not None else None
+
+
+def is_complete(path, url, checksum, timeout):
+	"""
+	Checks whether a file that is already on disk can be skipped, by checksum if one is known and by size otherwise.
+	"""
+
+	if not os.path.exists(path):
+		return False
+	if checksum:
+		return file_digest(path, checksum) == checksum
+	return os.path.getsize(path) == remote_size(url, timeout)
+
+
+def fetch(url, path, timeout):
+	"""
+	Downloads url to path + ".part", resuming from the end of an existing partial file with a Range request.
+
+	Please note:
+	> If the server ignores the Range header and sends the whole file, the partial file is started over.
+	> A run interrupted between the last chunk and the rename leaves a complete partial file, which the server answers with 416.
+	  It is renamed when its size matches the remote file, and started over otherwise. download_file then checks its checksum.
+
+	Returns
+	----------
+	> The number of bytes received.
+	"""
+
+	part_path = path + '.part'
+	offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+
+	request = urllib.request.Request(url)
+	if offset:
+		request.add_header('Range', 'bytes={}-'.format(offset))
+
+	try:
+		response = urllib.request.urlopen(request, timeout=timeout)
+	except urllib.error.HTTPError as error:
+		if not offset or error.code != 416:
+			raise
+
+		# Content-Range of a 416 is "bytes */<size of the file>".
+		content_range = error.headers.get('Content-Range', '')
+		total = int(content_range.rsplit('/', 1)[1]) if content_range.rpartition('/')[2].isdigit() else remote_size(url, timeout)
+		if total is not None and total != offset:
+			os.remove(part_path)
+			raise ValueError("Partial file of {} is larger than the remote file".format(url))
+		os.replace(part_path, path)
+		return 0
+
+	received = 0
+	with response:
+		if offset and response.status != 206:
+			offset = 0
+		length = response.headers.get('Content-Length')
+		expected = offset + int(length) if length is not None else None
+
+		with open(part_path, 'ab' if offset else 'wb') as part_file:
+			for chunk in iter(lambda: response.read(CHUNK_SIZE), b''):
+				part_file.write(chunk)
+				received += len(chunk)
+
+	if expected is not None and os.path.getsize(part_path) != expected:
+		raise http.client.IncompleteRead(b'', expected - os.path.getsize(part_path))
+
+	os.replace(part_path, path)
+	return received
+
+
+def download_file(url, path, retries=5, backoff=1.0, timeout=60, checksum=None):
+	"""
+	Downloads a single file with retries and exponential backoff. Files already on disk are skipped and partial downloads are resumed.
+
+	Parameters
+	----------
+	>url (str): Link to the file.
+	>path (str): Destination of the file.
+	>retries (int): Number of extra attempts after a failed one. Default: 5.
+	>backoff (float): Seconds to wait before the first retry, doubled on every retry. Default: 1.0.
+	>timeout (float): Socket timeout in seconds. Default: 60.
+	>checksum (str): Expected md5 or sha256 hex digest of the file. Default: None, files are checked by size.
+
+	Returns
+	----------
+	> A tuple (status, number of bytes received), where status is "skipped" or "downloaded".
+	"""
+
+	for attempt in range(retries + 1):
+		try:
+			if is_complete(path, url, checksum, timeout):
+				return "skipped", 0
+
+			received = fetch(url, path, timeout)
+
+			if checksum and file_digest(path, checksum) != checksum:
+				os.remove(path)
+				raise ValueError("Checksum mismatch for {}".format(url))
+			return "downloaded", received
+
+		except urllib.error.HTTPError as error:
+			if error.code not in RETRY_STATUS_CODES or attempt == retries:
+				raise
+		except (urllib.error.URLError, http.client.HTTPException, socket.timeout, ConnectionError, ValueError):
+			if attempt == retries:
+				raise
+
+		time.sleep(backoff * 2 ** attempt)
+
+
+def download_images(link_file_images, output_directory, image_type, num_workers=8, retries=5, backoff=1.0, timeout=60, checksums=None):
+	"""
+	Reads a file with links to the images, and downloads them to the specified location with a pool of threads.
+
+	Please note:
+	> Rerunning after an interruption only fetches what is missing: complete files are skipped and ".part" files are resumed.
+	> A file that still fails after all retries is reported, it does not stop the other downloads.
 
 	Parameters
    	----------
 	>link_file_images (str): path to the file with images.
 	>output_directory (str): path to target directory.
 	>image_type (str): Whether the images are target masks or satellite images.
+	>num_workers (int): Number of concurrent downloads. Default: 8.
+	>retries (int): Number of extra attempts per file. Default: 5.
+	>backoff (float): Seconds to wait before the first retry, doubled on every retry. Default: 1.0.
+	>timeout (float): Socket timeout in seconds. Default: 60.
+	>checksums (dict): Optional mapping of file names to md5 or sha256 hex digests, see read_checksums.
+
+	Returns
+	----------
+	> A dictionary with the number of downloaded, skipped and failed files, the bytes received and the elapsed seconds.
 	"""
 
 	print("\nDownloading", image_type)
-	
-	counter = 0
 
 	with open(link_file_images, 'r') as link_file:
-		image_links = link_file.readlines()
+		image_links = [line.strip() for line in link_file if line.strip()]
+
+	target_directory = os.path.join(output_directory, image_type)
+	os.makedirs(target_directory, exist_ok=True)
 
-	for image_link in tqdm(image_links, total = len(image_links)):
-		
-		image_path = output_directory + image_type + "/" + os.path.basename(image_link)
-		
-		urllib.request.urlretrieve(image_link, image_path)
-		
-		counter += 1
-	
-	print("{} images downloaded to {}\n".format(counter, output_directory+image_type))
+	summary = {"downloaded": 0, "skipped": 0, "failed": 0, "bytes": 0}
+	failures = []
+	start_time = time.time()
 
+	with ThreadPoolExecutor(max_workers=num_workers) as executor:
+		futures = {}
+		for image_link in image_links:
+			filename = os.path.basename(image_link)
+			image_path = os.path.join(target_directory, filename)
+			checksum = checksums.get(filename) if checksums else None
+			futures[executor.submit(download_file, image_link, image_path, retries, backoff, timeout, checksum)] = image_link
 
-if __name__ == '__main__':
-	
-	dataset_name = "MassachusettsRoads"
-	link_file_images = "../Data/_Links/{}}/Images.txt".format(dataset_name)
-	link_file_targets = "../Data/_Links/{}}/Targets.txt".format(dataset_name)
-	output_directory = "../Data/{}/".format(dataset_name)
+		for future in tqdm(as_completed(futures), total=len(futures)):
+			try:
+				status, received = future.result()
+				summary[status] += 1
+				summary["bytes"] += received
+			except Exception as error:
+				summary["failed"] += 1
+				failures.append((futures[future], error))
+
+	summary["seconds"] = time.time() - start_time
 
-	if not os.path.exists(output_directory):
-		os.mkdir(output_directory)
-		os.mkdir(output_directory + "Images/")
-		os.mkdir(output_directory + "Targets/")
+	for image_link, error in failures:
+		print("FAILED: {} ({})".format(image_link, error))
+	print("{} images downloaded, {} skipped, {} failed in {} seconds to {}".format(summary["downloaded"], summary["skipped"], summary["failed"], round(summary["seconds"], 2), target_directory))
+	print("Throughput: {} MB/s\n".format(round(summary["bytes"] / (1 << 20) / max(summary["seconds"], 1e-9), 2)))
+
+	return summary
+
+
+@click.command()
+@click.option('--dataset_name', default="MassachusettsRoads", help="Name of the folder in Data/_Links with the link files.")
+@click.option('--num_workers', default=8, help="Number of concurrent downloads.")
+@click.option('--retries', default=5, help="Number of extra attempts per file.")
+@click.option('--checksum_file', default=None, help="Optional md5sum/sha256sum style file to verify the downloads with.")
+def main(dataset_name, num_workers, retries, checksum_file):
+
+	link_file_images = "../Data/_Links/{}/Images.txt".format(dataset_name)
+	link_file_targets = "../Data/_Links/{}/Targets.txt".format(dataset_name)
+	output_directory = "../Data/{}/".format(dataset_name)
+	checksums = read_checksums(checksum_file) if checksum_file else None
 
 	start_time = time.time()
-	download_images(link_file_images, output_directory, "Images")
-	download_images(link_file_targets, output_directory, "Targets")
-	print("TOTAL TIME: {} minutes".format(round((time.time() - start_time)/60, 2)))
\ No newline at end of file
+	download_images(link_file_images, output_directory, "Images", num_workers, retries, checksums=checksums)
+	download_images(link_file_targets, output_directory, "Targets", num_workers, retries, checksums=checksums)
+	print("TOTAL TIME: {} minutes".format(round((time.time() - start_time)/60, 2)))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,239 @@
+"""
+Filename: augmentation.py
+
+Function: Augments batches of images and their masks together, with one random transform per sample applied to both.
+
+Author: Jerin Paul (https://github.com/Paulymorphous)
+Website: https://www.livetheaiexperience.com/
+"""
+
+import warnings
+
+import numpy as np
+
+from dataset_stats import featurewise_parameters
+
+FEATUREWISE_SETTINGS = ("featurewise_center", "featurewise_std_normalization", "zca_whitening")
+GEOMETRIC_SETTINGS = ("rotation_range", "width_shift_range", "height_shift_range", "shear_range", "zoom_range", "horizontal_flip", "vertical_flip")
+
+
+def get_boolean(string):
+    if string == "True":
+        return True
+    elif string == "False":
+        return False
+
+
+def augmentation_settings(augmentation_parameters):
+    """
+    Reads the augmentation options of the config into plain Python values.
+
+    Parameters
+    ----------
+    >augmentation_parameters (Object of ConfigParser SectionProxy): Configurations from for Augmentation.
+
+    Returns
+    ----------
+    > A dictionary with the same keys as the config section.
+    """
+
+    settings = {}
+    for key in ("rotation_range", "width_shift_range", "height_shift_range", "shear_range", "zoom_range", "channel_shift_range", "cval", "rescale", "zca_epsilon"):
+        settings[key] = float(augmentation_parameters[key])
+    for key in ("horizontal_flip", "vertical_flip", "samplewise_center", "samplewise_std_normalization", "featurewise_center", "featurewise_std_normalization", "zca_whitening"):
+        settings[key] = get_boolean(augmentation_parameters[key])
+    settings["fill_mode"] = augmentation_parameters["fill_mode"]
+    return settings
+
+
+def featurewise_steps(settings, stats):
+    """
+    Parameters of the featurewise options of the config, see dataset_stats.featurewise_parameters. They are all None when the options
+    are off, or with a warning when they are on and stats is None.
+    """
+
+    if not any(settings[key] for key in FEATUREWISE_SETTINGS):
+        return {"mean": None, "std": None, "zca": None}
+    if stats is None:
+        warnings.warn("Featurewise options are on but no dataset statistics were given, they are not applied. Run dataset_stats.py first.")
+        return {"mean": None, "std": None, "zca": None}
+    return featurewise_parameters(stats, settings)
+
+
+def sample_transforms(num_samples, height, width, settings, random_state):
+    """
+    Samples the rotation, shift, shear, zoom and flips of ImageDataGenerator for a batch, folded into one affine matrix per sample.
+
+    Returns
+    ----------
+    > An array of shape (num_samples, 2, 3) mapping output pixel coordinates (x, y, 1) to input pixel coordinates, around the centre of the image.
+    """
+
+    def uniform(bound):
+        return random_state.uniform(-bound, bound, num_samples)
+
+    theta = np.deg2rad(uniform(settings["rotation_range"]))
+    shear = np.deg2rad(uniform(settings["shear_range"]))
+    zoom_x = 1 + uniform(settings["zoom_range"])
+    zoom_y = 1 + uniform(settings["zoom_range"])
+
+    width_shift, height_shift = settings["width_shift_range"], settings["height_shift_range"]
+    shift_x = uniform(width_shift) * (width if width_shift < 1 else 1)
+    shift_y = uniform(height_shift) * (height if height_shift < 1 else 1)
+
+    cos, sin = np.cos(theta), np.sin(theta)
+    matrices = np.zeros((num_samples, 3, 3))
+    matrices[:, 0, 0] = cos * zoom_x
+    matrices[:, 0, 1] = (-cos * np.sin(shear) - sin * np.cos(shear)) * zoom_y
+    matrices[:, 1, 0] = sin * zoom_x
+    matrices[:, 1, 1] = (-sin * np.sin(shear) + cos * np.cos(shear)) * zoom_y
+    matrices[:, 2, 2] = 1
+
+    center_x, center_y = (width - 1) / 2, (height - 1) / 2
+    matrices[:, 0, 2] = center_x - matrices[:, 0, 0] * center_x - matrices[:, 0, 1] * center_y + shift_x
+    matrices[:, 1, 2] = center_y - matrices[:, 1, 0] * center_x - matrices[:, 1, 1] * center_y + shift_y
+
+    # A flip mirrors the output coordinates before they go through the matrix.
+    for flip, axis, size in (("horizontal_flip", 0, width), ("vertical_flip", 1, height)):
+        if settings[flip]:
+            flipped = random_state.uniform(size=num_samples) < 0.5
+            matrices[flipped, :, 2] += matrices[flipped, :, axis] * (size - 1)
+            matrices[flipped, :, axis] *= -1
+
+    return matrices[:, :2]
+
+
+def _fill_indices(indices, size, fill_mode):
+    # Maps coordinates outside the image back inside following fill_mode, and flags the ones that should get cval.
+    if fill_mode == "nearest":
+        return np.clip(indices, 0, size - 1), None
+    if fill_mode == "reflect":
+        indices = np.mod(indices, 2 * size)
+        return np.where(indices >= size, 2 * size - 1 - indices, indices), None
+    if fill_mode == "wrap":
+        return np.mod(indices, size), None
+    return np.clip(indices, 0, size - 1), (indices >= 0) & (indices < size)
+
+
+def warp_batch(batch, transforms, order, fill_mode="constant", cval=0.):
+    """
+    Applies one affine transform per sample to a whole batch with vectorized gathers.
+
+    Parameters
+    ----------
+    >batch (numpy array): Batch of shape (n, height, width) or (n, height, width, channels).
+    >transforms (numpy array): Matrices of shape (n, 2, 3), see sample_transforms.
+    >order (int): 0 for nearest neighbour, 1 for bilinear interpolation.
+    >fill_mode (str): "constant", "nearest", "reflect" or "wrap", as in ImageDataGenerator. Default: "constant".
+    >cval (float): Value of the points outside the image with fill_mode "constant". Default: 0.
+
+    Returns
+    ----------
+    > The warped batch, float32 for bilinear interpolation and of the input dtype for nearest neighbour.
+    """
+
+    num_samples, height, width = batch.shape[:3]
+    ys, xs = np.mgrid[0:height, 0:width].astype(np.float32)
+    transforms = transforms.astype(np.float32)[:, :, :, np.newaxis, np.newaxis]
+    source_x = transforms[:, 0, 0] * xs + transforms[:, 0, 1] * ys + transforms[:, 0, 2]
+    source_y = transforms[:, 1, 0] * xs + transforms[:, 1, 1] * ys + transforms[:, 1, 2]
+    samples = np.arange(num_samples)[:, np.newaxis, np.newaxis]
+    channel_axis = (np.newaxis,) * (batch.ndim - 3)
+
+    if order == 0:
+        x, valid_x = _fill_indices(np.rint(source_x).astype(np.intp), width, fill_mode)
+        y, valid_y = _fill_indices(np.rint(source_y).astype(np.intp), height, fill_mode)
+        warped = batch[samples, y, x]
+        if fill_mode == "constant":
+            warped[~(valid_x & valid_y)] = cval
+        return warped
+
+    x0, y0 = np.floor(source_x), np.floor(source_y)
+    weight_x, weight_y = source_x - x0, source_y - y0
+    x0, y0 = x0.astype(np.intp), y0.astype(np.intp)
+
+    warped = np.zeros(batch.shape, dtype=np.float32)
+    for dy, row_weight in ((0, 1 - weight_y), (1, weight_y)):
+        y, valid_y = _fill_indices(y0 + dy, height, fill_mode)
+        for dx, column_weight in ((0, 1 - weight_x), (1, weight_x)):
+            x, valid_x = _fill_indices(x0 + dx, width, fill_mode)
+            values = batch[samples, y, x].astype(np.float32)
+            if fill_mode == "constant":
+                values[~(valid_x & valid_y)] = cval
+            warped += (row_weight * column_weight)[(Ellipsis,) + channel_axis] * values
+    return warped
+
+
+class PairedAugmenter:
+    """
+    Augments images and masks together: every sample gets one random transform, applied to the whole batch in one vectorized warp per array.
+
+    Please note:
+    > Images are interpolated bilinearly and filled following fill_mode and cval. Masks use nearest neighbour, are filled with 0 and stay binary.
+    > channel_shift_range, rescale and the samplewise options only touch the images. Masks are returned as 0 and 1 with a channel axis.
+    > featurewise_center, featurewise_std_normalization and zca_whitening use the statistics of dataset_stats.py, passed as stats,
+      and are skipped with a warning without them. See dataset_stats.featurewise_parameters.
+
+    Parameters
+    ----------
+    >settings (dict): Output of augmentation_settings.
+    >seed (int): Seeds the random transforms. Default: 42.
+    >random_transforms (bool): False to only apply the deterministic steps (rescale, samplewise and featurewise options), for test data. Default: True.
+    >stats (dict): Dataset statistics from dataset_stats.load_stats, for the featurewise options. Default: None.
+
+    Example
+    ----------
+    > augmenter = PairedAugmenter(augmentation_settings(config["augmentation"]))
+      images, masks = augmenter(uint8_images, uint8_masks)
+    """
+
+    def __init__(self, settings, seed=42, random_transforms=True, stats=None):
+        self.settings = settings
+        self.random_state = np.random.RandomState(seed)
+        self.random_transforms = random_transforms
+        self.geometric = random_transforms and any(settings[key] for key in GEOMETRIC_SETTINGS)
+
+        self.featurewise = featurewise_steps(settings, stats)
+
+    def __call__(self, images, masks):
+        """
+        Parameters
+        ----------
+        >images (numpy array): uint8 images of shape (n, height, width, 3).
+        >masks (numpy array): uint8 masks of shape (n, height, width).
+
+        Returns
+        ----------
+        > A tuple (images, masks) of float32 arrays of shape (n, height, width, 3) and (n, height, width, 1).
+        """
+
+        settings = self.settings
+        masks = masks > 0
+
+        if self.geometric:
+            transforms = sample_transforms(len(images), images.shape[1], images.shape[2], settings, self.random_state)
+            images = warp_batch(images, transforms, 1, settings["fill_mode"], settings["cval"])
+            masks = warp_batch(masks, transforms, 0, settings["fill_mode"], False)
+
+        images = images.astype(np.float32)
+
+        if self.random_transforms and settings["channel_shift_range"]:
+            shifts = self.random_state.uniform(-settings["channel_shift_range"], settings["channel_shift_range"], (len(images), 1, 1, 1)).astype(np.float32)
+            images = np.clip(images + shifts, images.min(axis=(1, 2, 3), keepdims=True), images.max(axis=(1, 2, 3), keepdims=True))
+
+        if settings["rescale"]:
+            images *= settings["rescale"]
+        if settings["samplewise_center"]:
+            images -= images.mean(axis=(1, 2, 3), keepdims=True)
+        if settings["samplewise_std_normalization"]:
+            images /= images.std(axis=(1, 2, 3), keepdims=True) + 1e-6
+
+        featurewise = self.featurewise
+        if featurewise["mean"] is not None:
+            images -= featurewise["mean"]
+        if featurewise["std"] is not None:
+            images /= featurewise["std"]
+        if featurewise["zca"] is not None:
+            images = images @ featurewise["zca"]
+
+        return images, masks.astype(np.float32)[..., np.newaxis]
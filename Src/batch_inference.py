@@ -0,0 +1,322 @@
+"""
+Filename: batch_inference.py
+
+Function: Predicts road masks for a whole directory, glob or list of scenes. Decoding, prediction and writing run as a pipeline of threads joined by bounded queues, so the model is never waiting on disk.
+
+Author: Jerin Paul (https://github.com/Paulymorphous)
+Website: https://www.livetheaiexperience.com/
+"""
+
+import glob
+import json
+import os
+import queue
+import threading
+import time
+
+import click
+import numpy as np
+
+from inference import MODEL_PATH, Predictor, open_scene, prepare_image
+from postprocessing import THRESHOLD, clean_up_predictions, encode_mask, threshold_batch
+from tile_filters import BackgroundFilter
+
+IMAGE_EXTENSIONS = ('.tif', '.tiff', '.png', '.jpg', '.jpeg', '.bmp')
+OUTPUT_EXTENSIONS = {"png": ".png", "packed": ".npz", "rle": ".json", "polygons": ".json"}
+
+# Marks the end of a queue.
+_DONE = object()
+
+
+def list_scenes(source):
+    """
+    Lists the scenes to predict from a directory, a text file with one path per line, or a glob pattern.
+    """
+
+    if os.path.isdir(source):
+        return sorted(os.path.join(source, filename) for filename in os.listdir(source) if filename.lower().endswith(IMAGE_EXTENSIONS))
+    if os.path.isfile(source) and not source.lower().endswith(IMAGE_EXTENSIONS):
+        with open(source, 'r') as scene_list:
+            return [line.strip() for line in scene_list if line.strip()]
+    return sorted(glob.glob(source))
+
+
+def output_paths(scenes, output_directory, output_format):
+    """
+    Output path of every scene. The path of the scene relative to the deepest directory common to all the scenes is mirrored
+    in output_directory, so scenes with the same file name in different directories (like z/x/y tile layouts) do not collide.
+
+    Please note:
+    > Scenes that would still share an output, like a.tif and a.png in the same directory, are refused with a ValueError
+      before anything is predicted, as one would overwrite the other or be taken as already done on resume.
+
+    Returns
+    ----------
+    > A dictionary mapping every scene to the path of its mask.
+    """
+
+    if not scenes:
+        return {}
+
+    root = os.path.commonpath([os.path.dirname(os.path.abspath(scene)) for scene in scenes])
+    paths, sources = {}, {}
+    for scene in scenes:
+        relative_path = os.path.relpath(os.path.abspath(scene), root)
+        path = os.path.join(output_directory, os.path.splitext(relative_path)[0] + OUTPUT_EXTENSIONS[output_format])
+        sources.setdefault(path, []).append(scene)
+        paths[scene] = path
+
+    duplicates = [sorted(duplicate) for duplicate in sources.values() if len(duplicate) > 1]
+    if duplicates:
+        raise ValueError("Scenes with the same output: {}".format("; ".join(", ".join(duplicate) for duplicate in duplicates)))
+    return paths
+
+
+def write_mask(mask, path, output_format):
+    """
+    Writes a uint8 mask in the given format. The file is written under a temporary name and renamed, so an interrupted run never leaves a partial output that would be skipped on resume.
+    """
+
+    import cv2
+
+    directory, filename = os.path.split(path)
+    temporary_path = os.path.join(directory, ".tmp_" + filename)
+    os.makedirs(directory, exist_ok=True)
+
+    if output_format == "png":
+        cv2.imwrite(temporary_path, mask)
+    elif output_format == "packed":
+        packed = encode_mask(mask, "packed")
+        with open(temporary_path, 'wb') as output_file:
+            np.savez(output_file, bits=packed["bits"], shape=np.asarray(packed["shape"]))
+    else:
+        with open(temporary_path, 'w') as output_file:
+            json.dump(encode_mask(mask, output_format), output_file)
+
+    os.replace(temporary_path, path)
+
+
+class StageTimer:
+    """
+    Thread-safe accumulator of the seconds spent in every stage of the pipeline.
+    """
+
+    def __init__(self):
+        self.seconds = {}
+        self.lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self.lock:
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+
+
+def run_batch_inference(scenes, output_directory, predictor, batch_size=32, decode_workers=4, write_workers=2, queue_size=64,
+                        output_format="png", tiled=False, overlap=32, threshold=THRESHOLD, background_filter=None):
+    """
+    Streams scenes through decode, predict and write stages running concurrently.
+
+    Please note:
+    > decode_workers threads read and prepare the scenes, the calling thread feeds batches to the model and post-processes them,
+      and write_workers threads encode and write the masks. The queues between the stages hold at most queue_size items, so memory stays bounded.
+      With tiled, scenes and masks can be large: the queues hold at most decode_workers scenes and write_workers masks, and scenes are
+      opened with open_scene, so memory-mapped ones are read window by window.
+    > Scenes whose output already exists are skipped, rerunning the same command resumes an interrupted run. See output_paths for the
+      names of the outputs.
+    > A scene that cannot be decoded, predicted or written is reported as failed, the others go on.
+    > Without tiled, every scene is resized to the model input and the mask resized back, like inference.predict. With tiled, every scene
+      is predicted at full resolution with predict_tiled, one scene at a time.
+    > The time spent in every stage is summed over its threads. "wait_for_decode" and "wait_for_write" are the time the model thread spent
+      blocked on the other stages, a large value points at that stage as the bottleneck.
+    > With tiled and a background_filter, nodata and uniform windows are not sent to the model. The skipped windows and the estimated
+      time saved are reported.
+
+    Parameters
+    ----------
+    >scenes (list): Paths of the scenes.
+    >output_directory (str): Directory to write the masks to.
+    >predictor (inference.Predictor): Loaded model.
+    >batch_size (int): Number of scenes per call to the model. Default: 32.
+    >decode_workers (int): Number of decoding threads. Default: 4.
+    >write_workers (int): Number of writing threads. Default: 2.
+    >queue_size (int): Capacity of each queue between the stages. Default: 64.
+    >output_format (str): "png", "packed", "rle" or "polygons". Default: "png".
+    >tiled (bool): Predict every scene at full resolution with overlapping windows. Default: False.
+    >overlap (int): Overlap of the windows when tiled. Default: 32.
+    >threshold (float): Probability above which a pixel is a road. Default: 0.05.
+    >background_filter (tile_filters.BackgroundFilter): Optional filter of the windows to skip when tiled. Default: None.
+
+    Returns
+    ----------
+    > A dictionary with the number of scenes written, skipped and failed, and the seconds per stage.
+    """
+
+    import cv2
+
+    os.makedirs(output_directory, exist_ok=True)
+    start_time = time.perf_counter()
+    timer = StageTimer()
+    failures = []
+    tile_stats = {"tiles": 0, "skipped": 0, "seconds_saved": 0.}
+
+    paths = output_paths(scenes, output_directory, output_format)
+    pending = [scene for scene in scenes if not os.path.exists(paths[scene])]
+    num_skipped = len(scenes) - len(pending)
+
+    scene_queue = queue.Queue()
+    for scene in pending:
+        scene_queue.put(scene)
+    decoded_queue = queue.Queue(maxsize=decode_workers if tiled else queue_size)
+    write_queue = queue.Queue(maxsize=write_workers if tiled else queue_size)
+
+    def decode():
+        while True:
+            try:
+                scene = scene_queue.get_nowait()
+            except queue.Empty:
+                break
+
+            stage_start = time.perf_counter()
+            try:
+                if tiled:
+                    item = (scene, open_scene(scene), None)
+                else:
+                    image = cv2.imread(scene, cv2.IMREAD_COLOR)
+                    if image is None:
+                        raise ValueError("could not be decoded")
+                    item = (scene,) + prepare_image(image[..., ::-1])
+            except Exception as error:
+                failures.append((scene, error))
+                continue
+            finally:
+                timer.add("decode", time.perf_counter() - stage_start)
+
+            decoded_queue.put(item)
+        decoded_queue.put(_DONE)
+
+    def write():
+        while True:
+            item = write_queue.get()
+            if item is _DONE:
+                break
+
+            scene, mask = item
+            stage_start = time.perf_counter()
+            try:
+                write_mask(mask, paths[scene], output_format)
+            except Exception as error:
+                failures.append((scene, error))
+            timer.add("write", time.perf_counter() - stage_start)
+
+    decoders = [threading.Thread(target=decode, daemon=True) for _ in range(decode_workers)]
+    writers = [threading.Thread(target=write, daemon=True) for _ in range(write_workers)]
+    for thread in decoders + writers:
+        thread.start()
+
+    def put_masks(batch_scenes, masks):
+        stage_start = time.perf_counter()
+        for scene, mask in zip(batch_scenes, masks):
+            write_queue.put((scene, mask))
+        timer.add("wait_for_write", time.perf_counter() - stage_start)
+
+    running_decoders = decode_workers
+    batch = []
+
+    while running_decoders or batch:
+        if running_decoders:
+            stage_start = time.perf_counter()
+            item = decoded_queue.get()
+            timer.add("wait_for_decode", time.perf_counter() - stage_start)
+
+            if item is _DONE:
+                running_decoders -= 1
+            else:
+                batch.append(item)
+
+        if batch and (tiled or len(batch) == batch_size or not running_decoders):
+            batch_scenes = [scene for scene, _, _ in batch]
+
+            try:
+                stage_start = time.perf_counter()
+                if tiled:
+                    scene_stats = {}
+                    probabilities = predictor.predict_tiled(batch[0][1], overlap=overlap, batch_size=batch_size,
+                                                            background_filter=background_filter, stats=scene_stats)
+                    timer.add("predict", time.perf_counter() - stage_start)
+                    for key in tile_stats:
+                        tile_stats[key] += scene_stats[key]
+
+                    stage_start = time.perf_counter()
+                    masks = [threshold_batch(probabilities[np.newaxis], threshold)[0]]
+                    timer.add("postprocess", time.perf_counter() - stage_start)
+                else:
+                    preds = predictor.predict_batch(np.stack([np_img for _, np_img, _ in batch]), batch_size)
+                    timer.add("predict", time.perf_counter() - stage_start)
+
+                    stage_start = time.perf_counter()
+                    masks = clean_up_predictions(preds, [size for _, _, size in batch], threshold, output_format="array")
+                    timer.add("postprocess", time.perf_counter() - stage_start)
+            except Exception as error:
+                # Only the scenes of this batch fail, the run goes on with the next one.
+                failures.extend((scene, error) for scene in batch_scenes)
+            else:
+                put_masks(batch_scenes, masks)
+            batch = []
+
+    for _ in writers:
+        write_queue.put(_DONE)
+    for thread in decoders + writers:
+        thread.join()
+
+    num_written = len(pending) - len(failures)
+    summary = {
+        "written": num_written,
+        "skipped": num_skipped,
+        "failed": len(failures),
+        "seconds": time.perf_counter() - start_time,
+        "stages": timer.seconds,
+    }
+    if tiled:
+        summary["tiles"] = tile_stats
+
+    for scene, error in failures:
+        print("FAILED: {} ({})".format(scene, error))
+    print("{} masks written, {} skipped, {} failed in {} seconds.".format(summary["written"], summary["skipped"], summary["failed"], round(summary["seconds"], 2)))
+    if tiled and background_filter is not None:
+        print("{} of {} windows skipped as background, saving about {}s.".format(tile_stats["skipped"], tile_stats["tiles"], round(tile_stats["seconds_saved"], 2)))
+    print("Stage times: " + ", ".join("{} {}s".format(stage, round(seconds, 2)) for stage, seconds in sorted(timer.seconds.items())))
+
+    return summary
+
+
+@click.command()
+@click.argument('source')
+@click.argument('output_directory')
+@click.option('--model_path', default=MODEL_PATH, help="Path to the saved model.")
+@click.option('--batch_size', default=32, help="Number of scenes per call to the model.")
+@click.option('--decode_workers', default=4, help="Number of decoding threads.")
+@click.option('--write_workers', default=2, help="Number of writing threads.")
+@click.option('--queue_size', default=64, help="Capacity of each queue between the stages.")
+@click.option('--output_format', default="png", type=click.Choice(sorted(OUTPUT_EXTENSIONS)), help="Format of the masks.")
+@click.option('--tiled', is_flag=True, help="Predict every scene at full resolution with overlapping windows.")
+@click.option('--overlap', default=32, help="Overlap of the windows when tiled.")
+@click.option('--threshold', default=THRESHOLD, help="Probability above which a pixel is a road.")
+@click.option('--skip_background', is_flag=True, help="With --tiled, do not run the model on nodata and uniform windows.")
+@click.option('--cache_path', default=None, help="SQLite file of a prediction cache, so unchanged inputs are not predicted again.")
+def main(source, output_directory, model_path, batch_size, decode_workers, write_workers, queue_size, output_format, tiled, overlap, threshold, skip_background, cache_path):
+    """
+    Predicts the masks of every scene in SOURCE (a directory, a text file with one path per line, or a glob pattern) into OUTPUT_DIRECTORY.
+    """
+
+    scenes = list_scenes(source)
+    print("{} scenes found.".format(len(scenes)))
+
+    predictor = Predictor(model_path, cache_path=cache_path)
+    run_batch_inference(scenes, output_directory, predictor, batch_size, decode_workers, write_workers, queue_size,
+                        output_format, tiled, overlap, threshold, BackgroundFilter() if skip_background else None)
+
+    if predictor.cache is not None:
+        print("Prediction cache: {}".format(predictor.cache.stats()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,324 @@
+"""
+Filename: benchmark.py
+
+Function: Measures the throughput of dataset building, the input pipelines and inference on synthetic data, and writes the results as JSON so they can be compared across commits.
+
+Author: Jerin Paul (https://github.com/Paulymorphous)
+Website: https://www.livetheaiexperience.com/
+"""
+
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import click
+import cv2
+import numpy as np
+
+from build_dataset import crop_and_save
+from get_data_generators import GetDataGenerators, GetShardGenerators, GetTFDataPipelines
+from inference import Predictor
+
+# Augmentation config used by the pipeline benchmarks, in the format of the config file.
+AUGMENTATION_PARAMETERS = {
+    "featurewise_center": "False",
+    "samplewise_center": "False",
+    "featurewise_std_normalization": "False",
+    "samplewise_std_normalization": "False",
+    "zca_whitening": "False",
+    "zca_epsilon": "1e-06",
+    "rotation_range": "20",
+    "width_shift_range": "0.1",
+    "height_shift_range": "0.1",
+    "shear_range": "5",
+    "zoom_range": "0.1",
+    "channel_shift_range": "10",
+    "fill_mode": "reflect",
+    "cval": "0",
+    "horizontal_flip": "True",
+    "vertical_flip": "True",
+    "rescale": "0.00392156862745098",
+    "validation_split": "0.1",
+}
+
+
+# Modules that must import without the heavy frameworks below, and the time they may take to import.
+LIGHT_MODULES = ("acquire_data", "postprocessing", "tile_filters", "shards", "build_dataset", "augmentation", "dataset_stats",
+                 "prediction_cache", "evaluate", "inference", "batch_inference", "get_data_generators", "export_model")
+HEAVY_MODULES = ("tensorflow", "keras", "skimage", "PIL", "cv2")
+STARTUP_BUDGET_SECONDS = 1.0
+
+# Run in a fresh interpreter, so nothing is already imported.
+IMPORT_SCRIPT = """
+import json, sys, time
+start_time = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start_time
+print(json.dumps({{"seconds": seconds, "heavy": [name for name in {heavy} if name in sys.modules]}}))
+"""
+
+
+def make_synthetic_scene(size, random_state):
+    """
+    Builds a fake aerial scene and its road mask: textured noise with a few straight roads drawn on both.
+
+    Returns
+    ----------
+    > A tuple (uint8 image of shape (size, size, 3), uint8 mask of shape (size, size) with roads at 255).
+    """
+
+    image = random_state.randint(40, 120, (size, size, 3)).astype(np.uint8)
+    image = cv2.GaussianBlur(image, (7, 7), 0)
+    mask = np.zeros((size, size), dtype=np.uint8)
+
+    for _ in range(random_state.randint(6, 12)):
+        start = tuple(int(v) for v in random_state.randint(0, size, 2))
+        end = tuple(int(v) for v in random_state.randint(0, size, 2))
+        thickness = int(random_state.randint(6, 16))
+        cv2.line(image, start, end, (170, 170, 170), thickness)
+        cv2.line(mask, start, end, 255, thickness)
+
+    return image, mask
+
+
+def write_synthetic_dataset(root_path, num_scenes, scene_size, seed=42):
+    """
+    Writes num_scenes synthetic scenes in the layout build_dataset expects: sat/<name>.tiff and map/<name>.tif.
+    """
+
+    random_state = np.random.RandomState(seed)
+    for path in ("sat/", "map/"):
+        os.makedirs(os.path.join(root_path, path), exist_ok=True)
+
+    for n in range(num_scenes):
+        image, mask = make_synthetic_scene(scene_size, random_state)
+        cv2.imwrite(os.path.join(root_path, "sat", "scene_{}.tiff".format(n)), image)
+        cv2.imwrite(os.path.join(root_path, "map", "scene_{}.tif".format(n)), mask)
+
+
+def build_small_unet(img_size=256, filters=8, depth=3):
+    """
+    A small, randomly initialised U-Net with the input and output of the road model, so inference can be measured without downloading weights.
+    """
+
+    from tensorflow.keras import layers, Model
+
+    inputs = layers.Input((img_size, img_size, 3))
+    x = inputs
+    skips = []
+    for level in range(depth):
+        x = layers.Conv2D(filters * 2 ** level, (3, 3), activation='elu', padding='same')(x)
+        skips.append(x)
+        x = layers.MaxPooling2D((2, 2))(x)
+
+    x = layers.Conv2D(filters * 2 ** depth, (3, 3), activation='elu', padding='same')(x)
+
+    for level in reversed(range(depth)):
+        x = layers.Conv2DTranspose(filters * 2 ** level, (2, 2), strides=(2, 2), padding='same')(x)
+        x = layers.concatenate([x, skips[level]])
+        x = layers.Conv2D(filters * 2 ** level, (3, 3), activation='elu', padding='same')(x)
+
+    outputs = layers.Conv2D(1, (1, 1), activation='sigmoid')(x)
+    return Model(inputs=[inputs], outputs=[outputs])
+
+
+def percentiles(latencies):
+    latencies = np.asarray(latencies) * 1000
+    return {"p50_ms": float(np.percentile(latencies, 50)), "p99_ms": float(np.percentile(latencies, 99))}
+
+
+def benchmark_build(root_path, num_workers=None):
+    """
+    Times crop_and_save on the synthetic scenes, once per output format.
+
+    Returns
+    ----------
+    > A dictionary with tiles/sec per output format. Every crop of the scenes counts as a tile, including the ones dropped for lack of annotation.
+    """
+
+    results = {}
+
+    for output_format in ("files", "shards"):
+        images_path = os.path.join(root_path, "Crops_" + output_format, "Images", "samples") + "/"
+        masks_path = os.path.join(root_path, "Crops_" + output_format, "Masks", "samples") + "/"
+        os.makedirs(images_path, exist_ok=True)
+        os.makedirs(masks_path, exist_ok=True)
+
+        start_time = time.perf_counter()
+        num_written, _, num_tiles = crop_and_save(os.path.join(root_path, "sat") + "/", os.path.join(root_path, "map") + "/", images_path, masks_path,
+                                                  256, 256, num_workers=num_workers, output_format=output_format)
+        seconds = time.perf_counter() - start_time
+
+        results[output_format] = {"tiles": num_tiles, "written": num_written, "seconds": seconds, "tiles_per_sec": num_tiles / seconds}
+    return results
+
+
+def time_batches(batches, num_batches):
+    # The first batch pays for worker start up and graph tracing, it is timed separately.
+    start_time = time.perf_counter()
+    next(batches)
+    first_batch = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    for _ in range(num_batches):
+        next(batches)
+    seconds = time.perf_counter() - start_time
+
+    return {"first_batch_sec": first_batch, "batches": num_batches, "seconds": seconds, "batches_per_sec": num_batches / seconds}
+
+
+def benchmark_pipelines(root_path, batch_size, num_batches):
+    """
+    Times the training batches of GetDataGenerators, GetShardGenerators and GetTFDataPipelines on the crops written by benchmark_build.
+
+    Returns
+    ----------
+    > A dictionary with batches/sec per pipeline.
+    """
+
+    images_path = os.path.join(root_path, "Crops_files", "Images")
+    masks_path = os.path.join(root_path, "Crops_files", "Masks")
+    shards_path = os.path.join(root_path, "Crops_shards", "Images", "samples")
+
+    train_generator = GetDataGenerators(AUGMENTATION_PARAMETERS, images_path, masks_path, batch_size=batch_size)[0]
+    shard_generator = GetShardGenerators(AUGMENTATION_PARAMETERS, shards_path, batch_size=batch_size)[0]
+    tf_dataset = GetTFDataPipelines(AUGMENTATION_PARAMETERS, images_path, masks_path, batch_size=batch_size)[0]
+
+    def endless(dataset):
+        while True:
+            for batch in dataset:
+                yield batch
+
+    return {
+        "GetDataGenerators": time_batches(train_generator, num_batches),
+        "GetShardGenerators": time_batches(shard_generator, num_batches),
+        "GetTFDataPipelines": time_batches(endless(tf_dataset), num_batches),
+    }
+
+
+def benchmark_inference(root_path, batch_size, num_batches, num_single):
+    """
+    Times a Predictor serving a small random U-Net: batched throughput, single image latency and tiled inference on one synthetic scene.
+
+    Returns
+    ----------
+    > A dictionary with images/sec and p50/p99 latencies.
+    """
+
+    predictor = Predictor(model=build_small_unet())
+    random_state = np.random.RandomState(0)
+    images = [random_state.randint(0, 256, (256, 256, 3)).astype(np.uint8) for _ in range(batch_size)]
+
+    latencies = []
+    for _ in range(num_batches):
+        start_time = time.perf_counter()
+        predictor.predict(images, batch_size=batch_size)
+        latencies.append(time.perf_counter() - start_time)
+    batched = {"batch_size": batch_size, "images_per_sec": batch_size * num_batches / sum(latencies)}
+    batched.update(percentiles(latencies))
+
+    latencies = []
+    for n in range(num_single):
+        start_time = time.perf_counter()
+        predictor.predict(images[n % batch_size])
+        latencies.append(time.perf_counter() - start_time)
+    single = {"images_per_sec": num_single / sum(latencies)}
+    single.update(percentiles(latencies))
+
+    scene = cv2.imread(os.path.join(root_path, "sat", "scene_0.tiff"))[..., ::-1]
+    start_time = time.perf_counter()
+    predictor.predict_tiled(scene, batch_size=batch_size)
+    seconds = time.perf_counter() - start_time
+    tiled = {"scene_shape": list(scene.shape), "seconds": seconds, "megapixels_per_sec": scene.shape[0] * scene.shape[1] / 1e6 / seconds}
+
+    return {"batched": batched, "single": single, "tiled": tiled}
+
+
+def benchmark_startup(modules=LIGHT_MODULES, repeats=3):
+    """
+    Times the import of every module in a fresh interpreter and lists the heavy frameworks it pulled in.
+
+    Please note:
+    > The best of repeats runs is kept, the others mostly measure the disk cache.
+    > A module fails when it imports any of HEAVY_MODULES or takes more than STARTUP_BUDGET_SECONDS, see main's --check_startup.
+
+    Returns
+    ----------
+    > A dictionary with the import seconds, the heavy modules imported and the verdict of every module.
+    """
+
+    source_path = os.path.dirname(os.path.abspath(__file__))
+    results = {}
+
+    for module in modules:
+        script = IMPORT_SCRIPT.format(module=module, heavy=repr(HEAVY_MODULES))
+        runs = [json.loads(subprocess.check_output([sys.executable, "-c", script], cwd=source_path).decode().strip().splitlines()[-1])
+                for _ in range(repeats)]
+        seconds = min(run["seconds"] for run in runs)
+        heavy = runs[0]["heavy"]
+        results[module] = {"seconds": seconds, "heavy": heavy, "ok": not heavy and seconds <= STARTUP_BUDGET_SECONDS}
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@click.command()
+@click.option('--output', default="benchmark.json", help="File to write the results to.")
+@click.option('--stages', default="startup,build,pipeline,inference", help="Comma separated stages to run.")
+@click.option('--num_scenes', default=4, help="Number of synthetic scenes.")
+@click.option('--scene_size', default=1500, help="Height and width of the synthetic scenes.")
+@click.option('--batch_size', default=16, help="Batch size of the pipelines and of inference.")
+@click.option('--num_batches', default=20, help="Number of timed batches per pipeline and for batched inference.")
+@click.option('--num_single', default=50, help="Number of timed single image predictions.")
+@click.option('--num_workers', default=None, type=int, help="Worker processes for dataset building. Default: one per CPU.")
+@click.option('--check_startup', is_flag=True, help="Exit with an error when a module fails the startup stage.")
+def main(output, stages, num_scenes, scene_size, batch_size, num_batches, num_single, num_workers, check_startup):
+
+    stages = stages.split(",")
+    results = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "parameters": {"num_scenes": num_scenes, "scene_size": scene_size, "batch_size": batch_size, "num_batches": num_batches, "num_single": num_single},
+    }
+
+    root_path = tempfile.mkdtemp(prefix="skeyenet_benchmark_")
+    try:
+        if "startup" in stages:
+            results["startup"] = benchmark_startup()
+
+        write_synthetic_dataset(root_path, num_scenes, scene_size)
+
+        # The pipelines read the crops of the build stage.
+        if "build" in stages or "pipeline" in stages:
+            results["build"] = benchmark_build(root_path, num_workers)
+        if "pipeline" in stages:
+            results["pipeline"] = benchmark_pipelines(root_path, batch_size, num_batches)
+        if "inference" in stages:
+            results["inference"] = benchmark_inference(root_path, batch_size, num_batches, num_single)
+    finally:
+        shutil.rmtree(root_path)
+        # Written even when a stage fails, so the stages already measured are kept.
+        with open(output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+        print(json.dumps(results, indent=2))
+
+    failed = [module for module, result in results.get("startup", {}).items() if not result["ok"]]
+    if check_startup and failed:
+        raise click.ClickException("Startup regression in: {}".format(", ".join(failed)))
+
+
+if __name__ == '__main__':
+    main()
@@ -8,11 +8,15 @@ Website: https://www.livetheaiexperience.com/
 """
 
 import numpy as np
-import cv2
 from tqdm import tqdm
 import os
-import math
 import time
+import json
+import hashlib
+from shards import ShardWriter
+from tile_filters import BackgroundFilter
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
 def train_test_split(images_path, masks_path, test_split=0.3):
     """
@@ -62,11 +66,137 @@ def train_test_split(images_path, masks_path, test_split=0.3):
     print("\nTrain Directory:", train_dir)
     print("Test Directory:", test_dir)
 
-def crop_and_save(images_path, masks_path, new_images_path, new_masks_path, img_width, img_height):
+def tile_view(array, img_width, img_height):
+    """
+    Splits an image into non-overlapping crops as a strided view.
+    The image is zero padded on the bottom and right to a multiple of the crop size, like the blank images the crops used to be pasted on. Images that are already a multiple of the crop size are not copied.
+
+    Parameters
+    ----------
+    >array (numpy array): Image of shape (height, width) or (height, width, channels).
+    >img_width (int): width of a crop.
+    >img_height (int): height of a crop.
+
+    Returns
+    ----------
+    > A view of shape (rows, columns, img_height, img_width) or (rows, columns, img_height, img_width, channels).
+    """
+
+    pad_height = -array.shape[0] % img_height
+    pad_width = -array.shape[1] % img_width
+    if pad_height or pad_width:
+        array = np.pad(array, [(0, pad_height), (0, pad_width)] + [(0, 0)] * (array.ndim - 2), mode='constant')
+
+    rows, cols = array.shape[0] // img_height, array.shape[1] // img_width
+    return array.reshape((rows, img_height, cols, img_width) + array.shape[2:]).swapaxes(1, 2)
+
+def extract_tiles(image, mask, img_width, img_height, min_foreground_ratio=0.01, background_filter=None):
+    """
+    Crops an image and its mask in one go and keeps the crops with enough annotation.
+
+    Please note:
+    > Crops without any annotation are dropped silently. Crops whose ratio of annotated to empty pixels is below min_foreground_ratio are dropped and counted as skipped, as crop_and_save always did.
+    > Mask values above 1 are set to 255.
+    > With a background_filter, the crops that pass the annotation test are checked for nodata and uniform texture, and those it flags are dropped too.
+
+    Parameters
+    ----------
+    >image (numpy array): uint8 image of shape (height, width, 3).
+    >mask (numpy array): uint8 mask of shape (height, width).
+    >img_width (int): width of the cropped image.
+    >img_height (int): height of the cropped image.
+    >min_foreground_ratio (float): Minimum ratio of annotated to empty pixels. Default: 0.01.
+    >background_filter (tile_filters.BackgroundFilter): Optional filter of nodata and uniform crops. Default: None.
+
+    Returns
+    ----------
+    > numbers (numpy array): 1-based, row-major position of every kept crop in the image.
+    > image_tiles (numpy array): Kept image crops, of shape (n, img_height, img_width, 3).
+    > mask_tiles (numpy array): Kept mask crops, of shape (n, img_height, img_width).
+    > fractions (numpy array): Fraction of annotated pixels in every kept crop.
+    > num_skipped (int): Number of crops dropped for having too little annotation.
+    > num_background (int): Number of annotated crops dropped by background_filter.
+    """
+
+    mask = np.where(mask > 1, np.uint8(255), mask)
+
+    image_tiles = tile_view(image, img_width, img_height)
+    mask_tiles = tile_view(mask, img_width, img_height)
+
+    foreground = np.count_nonzero(mask_tiles, axis=(2, 3))
+    with np.errstate(divide='ignore'):
+        ratios = foreground / (img_width * img_height - foreground)
+
+    annotated = foreground > 0
+    keep = annotated & (ratios >= min_foreground_ratio)
+    num_skipped = int(np.count_nonzero(annotated & ~keep))
+
+    # Boolean indexing copies the kept crops only.
+    numbers = np.flatnonzero(keep) + 1
+    kept_images, kept_masks = image_tiles[keep], mask_tiles[keep]
+    fractions = foreground[keep] / (img_width * img_height)
+
+    num_background = 0
+    if background_filter is not None and len(numbers):
+        foreground_tiles = ~background_filter(kept_images)
+        num_background = len(numbers) - int(np.count_nonzero(foreground_tiles))
+        if num_background:
+            numbers, kept_images, kept_masks, fractions = numbers[foreground_tiles], kept_images[foreground_tiles], kept_masks[foreground_tiles], fractions[foreground_tiles]
+
+    return numbers, kept_images, kept_masks, fractions, num_skipped, num_background
+
+def tile_file(image_file, images_path, masks_path, new_images_path, new_masks_path, img_width, img_height, output_format="files", background_filter=None):
+    """
+    Crops one source image and its mask and writes the kept crops. Runs in the worker processes of crop_and_save.
+
+    Please note:
+    > With output_format "shards" nothing is written, the crops are returned so that crop_and_save can pack them with a ShardWriter.
+
+    Returns
+    ----------
+    > A tuple (number of crops kept, number of crops skipped, number of background crops dropped, number of crops in the image, seconds spent per stage, crops).
+      crops is the list of crop file names written for output_format "files", and the arguments of ShardWriter.add for "shards".
+    """
+
+    import cv2
+
+    timings = {}
+
+    start_time = time.perf_counter()
+    image = cv2.imread(images_path + image_file)
+    mask = cv2.imread(masks_path + image_file[:-1], 0)
+    timings["read"] = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    numbers, image_tiles, mask_tiles, fractions, num_skipped, num_background = extract_tiles(image, mask, img_width, img_height, background_filter=background_filter)
+    timings["tile"] = time.perf_counter() - start_time
+
+    num_cols = -(-image.shape[1] // img_width)
+    num_tiles = -(-image.shape[0] // img_height) * num_cols
+
+    if output_format == "shards":
+        rows = (numbers - 1) // num_cols * img_height
+        cols = (numbers - 1) % num_cols * img_width
+        # OpenCV reads BGR, shards hold RGB like every other input of the model.
+        return len(numbers), num_skipped, num_background, num_tiles, timings, (image_file, image_tiles[..., ::-1], mask_tiles, rows, cols, fractions)
+
+    start_time = time.perf_counter()
+    crop_files = [str(number) + '_' + image_file for number in numbers]
+    for crop_file, image_tile, mask_tile in zip(crop_files, image_tiles, mask_tiles):
+        cv2.imwrite(new_images_path + crop_file, image_tile)
+        cv2.imwrite(new_masks_path + crop_file, mask_tile)
+    timings["write"] = time.perf_counter() - start_time
+
+    return len(numbers), num_skipped, num_background, num_tiles, timings, crop_files
+
+def crop_and_save(images_path, masks_path, new_images_path, new_masks_path, img_width, img_height, num_workers=None, output_format="files", shard_size=512, background_filter=None):
     """
     Imports Images and creates multiple crops and then stores them in the specified folder. Cropping is important in the project to protect spatial information, which otherwise would be lost if we resize the images.
     Please note:
     > All the images which has less than 1% annotation, in terms of area is removed. In other words, Images that are 99% empty are removed.
+    > Source images are processed in parallel by a pool of num_workers processes. The time spent reading, tiling and writing is summed over all workers and reported at the end.
+    > With output_format "shards" the crops are packed into large .npy shards in new_images_path instead of one file per crop, and new_masks_path is not used. Read them back with shards.ShardDataset.
+    > With a background_filter, annotated crops that are mostly nodata or uniform are dropped before anything is written. Their number and the estimated write time saved are reported.
 
     Parameters
    	----------
@@ -76,58 +206,224 @@ def crop_and_save(images_path, masks_path, new_images_path, new_masks_path, img_
 	>new_masks_path (str): Path to the Directory where the cropped masks will be stored.
 	>img_width (int): width of the cropped image.
     >img_height (int): height of the cropped image.
+    >num_workers (int): Number of worker processes. Default: None, one per CPU. Use 1 to run in the current process.
+    >output_format (str): "files" for one image file per crop, or "shards". Default: "files".
+    >shard_size (int): Number of crops per shard when output_format is "shards". Default: 512.
+    >background_filter (tile_filters.BackgroundFilter): Optional filter of nodata and uniform crops. Default: None.
+
+    Returns
+    ----------
+    > A tuple (number of crops written, number of crops skipped, number of crops processed). The crops processed include the ones
+      dropped silently for having no annotation.
     """
-    
+
     print("Building Dataset.")
-    
-    num_skipped = 0
+
+    num_written = num_skipped = num_background = num_tiles = 0
+    timings = {"read": 0.0, "tile": 0.0, "write": 0.0}
     start_time = time.time()
     files = next(os.walk(images_path))[2]
     print('Total number of files =',len(files))
-    
-    for image_file in tqdm(files, total = len(files)):
-       
-        image_path = images_path + image_file
-        image = cv2.imread(image_path)
-        
-        mask_path = masks_path + image_file[:-1]
-        mask = cv2.imread(mask_path, 0)
-        
-        num_splits = math.floor((image.shape[0]*image.shape[1])/(img_width*img_height))
-        counter = 0
-        
-        for r in range(0, image.shape[0], img_height):
-            for c in range(0, image.shape[1], img_width):
-                counter += 1
-                blank_image = np.zeros((img_height ,img_width, 3), dtype = int)
-                blank_mask = np.zeros((img_height ,img_width), dtype = int)
-                
-                new_image_path = new_images_path + str(counter) + '_' + image_file
-                new_mask_path = new_masks_path + str(counter) + '_' + image_file
-                
-                new_image = np.array(image[r:r+img_height, c:c+img_width,:])
-                new_mask = np.array(mask[r:r+img_height, c:c+img_width])
-            
-                
-                blank_image[:new_image.shape[0], :new_image.shape[1], :] += new_image
-                blank_mask[:new_image.shape[0], :new_image.shape[1]] += new_mask
-                
-                blank_mask[blank_mask>1] = 255
-                
-                # Skip any Image that is more than 99% empty.
-                if np.any(blank_mask):
-                    num_black_pixels, num_white_pixels = np.unique(blank_mask, return_counts=True)[1]
-                    
-                    if num_white_pixels/num_black_pixels < 0.01:
-                        num_skipped+=1
-                        continue
-
-                    cv2.imwrite(new_image_path, blank_image)
-                    cv2.imwrite(new_mask_path, blank_mask)
-                
-    
-    print("EXPORT COMPLETE: {} seconds.\nImages exported to {}\nMasks exported to{}".format(round((time.time()-start_time), 2), new_images_path, new_masks_path))
-    print("\n{} Images were skipped.".format(num_skipped))
+
+    worker = partial(tile_file, images_path=images_path, masks_path=masks_path, new_images_path=new_images_path,
+                     new_masks_path=new_masks_path, img_width=img_width, img_height=img_height, output_format=output_format,
+                     background_filter=background_filter)
+    writer = ShardWriter(new_images_path, img_width, img_height, shard_size=shard_size) if output_format == "shards" else None
+
+    if num_workers == 1:
+        results = map(worker, files)
+        executor = None
+    else:
+        executor = ProcessPoolExecutor(max_workers=num_workers)
+        results = executor.map(worker, files, chunksize=4)
+
+    try:
+        for written, skipped, background, tiles, file_timings, crops in tqdm(results, total = len(files)):
+            num_written += written
+            num_skipped += skipped
+            num_background += background
+            num_tiles += tiles
+            for stage, seconds in file_timings.items():
+                timings[stage] += seconds
+
+            if writer is not None:
+                write_start = time.perf_counter()
+                writer.add(*crops)
+                timings["write"] += time.perf_counter() - write_start
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    if writer is not None:
+        write_start = time.perf_counter()
+        writer.close()
+        timings["write"] += time.perf_counter() - write_start
+
+    if writer is not None:
+        print("EXPORT COMPLETE: {} seconds.\nShards exported to {}".format(round((time.time()-start_time), 2), new_images_path))
+    else:
+        print("EXPORT COMPLETE: {} seconds.\nImages exported to {}\nMasks exported to{}".format(round((time.time()-start_time), 2), new_images_path, new_masks_path))
+    print("\n{} Images were written, {} Images were skipped.".format(num_written, num_skipped))
+    if background_filter is not None:
+        # Estimated from the average write time of the crops that were kept.
+        seconds_saved = num_background * timings["write"] / max(num_written, 1)
+        print("{} background crops were dropped before writing, saving about {}s of writes.".format(num_background, round(seconds_saved, 2)))
+    print("Stage times (summed over workers): " + ", ".join("{} {}s".format(stage, round(seconds, 2)) for stage, seconds in timings.items()))
+
+    return num_written, num_skipped, num_tiles
+
+
+MANIFEST_FILE = "manifest.json"
+
+def scene_hash(image_file, images_path, masks_path):
+    """
+    sha256 of the bytes of a source image and its mask, the identity of a scene for incremental builds.
+    """
+
+    hasher = hashlib.sha256()
+    for path in (images_path + image_file, masks_path + image_file[:-1]):
+        with open(path, 'rb') as source_file:
+            for chunk in iter(lambda: source_file.read(1 << 20), b''):
+                hasher.update(chunk)
+    return hasher.hexdigest()
+
+def scene_split(scene_id, test_split):
+    """
+    Assigns a scene to "train" or "test" from a hash of its id, so a scene keeps its split whatever scenes are added or removed later.
+    """
+
+    position = int(hashlib.sha256(scene_id.encode()).hexdigest()[:8], 16) / 16 ** 8
+    return "test" if position < test_split else "train"
+
+def load_manifest(manifest_path):
+    if not os.path.exists(manifest_path):
+        return {"parameters": None, "scenes": {}}
+    with open(manifest_path, 'r') as manifest_file:
+        return json.load(manifest_file)
+
+def save_json(path, data, indent=None):
+    # Written to a temporary file first, so an interrupted run never leaves a truncated file. Used for the manifest and dataset_stats.
+    with open(path + ".tmp", 'w') as json_file:
+        json.dump(data, json_file, indent=indent)
+    os.replace(path + ".tmp", path)
+
+def load_split(manifest_path, split):
+    """
+    Lists the crops of one split of an incremental build.
+
+    Parameters
+    ----------
+    >manifest_path (str): Path to the manifest.json written by build_incremental.
+    >split (str): "train" or "test".
+
+    Returns
+    ----------
+    > A sorted list of (image path, mask path) tuples.
+    """
+
+    manifest = load_manifest(manifest_path)
+    root_path = os.path.dirname(manifest_path)
+    images_path = os.path.join(root_path, manifest["images_path"])
+    masks_path = os.path.join(root_path, manifest["masks_path"])
+
+    pairs = []
+    for scene_id in sorted(manifest["scenes"]):
+        scene = manifest["scenes"][scene_id]
+        if scene["split"] == split:
+            pairs.extend((images_path + crop_file, masks_path + crop_file) for crop_file in scene["crops"])
+    return pairs
+
+def remove_crops(scene, new_images_path, new_masks_path):
+    for crop_file in scene["crops"]:
+        for path in (new_images_path + crop_file, new_masks_path + crop_file):
+            if os.path.exists(path):
+                os.remove(path)
+
+def build_incremental(root_data_path, img_width, img_height, test_split=0.3, num_workers=None, background_filter=None):
+    """
+    Crops only the scenes of sat/ that are new or changed since the last run, and splits the dataset by scene without moving any file.
+
+    Please note:
+    > root_data_path/manifest.json records the tiling parameters and, for every scene, the hash of its image and mask, its split and its crops.
+      A scene is re-cropped when its hash changes, and every scene is when the tiling parameters change. The crops of changed or deleted scenes are removed.
+    > Crops go to root_data_path/Images/samples/ and root_data_path/Masks/samples/ and stay there. The split is only recorded in the manifest, read it with load_split.
+    > A scene is in the test set when a hash of its file name falls below test_split, so adding imagery never moves existing scenes between the sets, and crops of one scene never end up in both.
+    > The manifest is saved after every batch of scenes, an interrupted build resumes where it stopped.
+
+    Parameters
+    ----------
+    >root_data_path (str): Path to the dataset, containing the sat/ and map/ directories.
+    >img_width (int): width of the cropped image.
+    >img_height (int): height of the cropped image.
+    >test_split (float): Expected ratio of test scenes to all scenes. Default: 0.3
+    >num_workers (int): Number of worker processes. Default: None, one per CPU. Use 1 to run in the current process.
+    >background_filter (tile_filters.BackgroundFilter): Optional filter of nodata and uniform crops, see crop_and_save. Its settings are part of the tiling parameters. Default: None.
+
+    Returns
+    ----------
+    > The manifest.
+    """
+
+    images_path = root_data_path + "sat/"
+    masks_path = root_data_path + "map/"
+    new_images_path = root_data_path + "Images/samples/"
+    new_masks_path = root_data_path + "Masks/samples/"
+    manifest_path = root_data_path + MANIFEST_FILE
+
+    for path in [new_images_path, new_masks_path]:
+        os.makedirs(path, exist_ok=True)
+
+    start_time = time.time()
+    parameters = {"img_width": img_width, "img_height": img_height, "min_foreground_ratio": 0.01}
+    if background_filter is not None:
+        parameters["background_filter"] = background_filter.settings()
+    manifest = load_manifest(manifest_path)
+    scenes = manifest["scenes"]
+
+    if manifest["parameters"] != parameters:
+        for scene in scenes.values():
+            remove_crops(scene, new_images_path, new_masks_path)
+        scenes = {}
+
+    manifest = {"parameters": parameters, "images_path": "Images/samples/", "masks_path": "Masks/samples/", "test_split": test_split, "scenes": scenes}
+    files = sorted(next(os.walk(images_path))[2])
+
+    executor = ProcessPoolExecutor(max_workers=num_workers) if num_workers != 1 else None
+    map_function = executor.map if executor is not None else map
+
+    try:
+        hashes = dict(zip(files, map_function(partial(scene_hash, images_path=images_path, masks_path=masks_path), files)))
+
+        removed = [scene_id for scene_id in scenes if scene_id not in hashes]
+        changed = [image_file for image_file in files if scenes.get(image_file, {}).get("hash") != hashes[image_file]]
+        for scene_id in removed + [image_file for image_file in changed if image_file in scenes]:
+            remove_crops(scenes.pop(scene_id), new_images_path, new_masks_path)
+
+        print("{} new or changed scenes, {} unchanged, {} removed.".format(len(changed), len(files) - len(changed), len(removed)))
+
+        worker = partial(tile_file, images_path=images_path, masks_path=masks_path, new_images_path=new_images_path,
+                         new_masks_path=new_masks_path, img_width=img_width, img_height=img_height, background_filter=background_filter)
+        results = map_function(worker, changed)
+
+        for n, (image_file, (_, skipped, background, _, _, crop_files)) in enumerate(tqdm(zip(changed, results), total = len(changed))):
+            scenes[image_file] = {"hash": hashes[image_file], "crops": crop_files, "skipped": skipped, "background": background,
+                                  "split": scene_split(image_file, test_split)}
+            if n % 50 == 49:
+                save_json(manifest_path, manifest)
+
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        # A new test_split moves scenes between the sets without cropping them again.
+        for scene_id, scene in scenes.items():
+            scene["split"] = scene_split(scene_id, test_split)
+        save_json(manifest_path, manifest)
+
+    num_test = sum(scene["split"] == "test" for scene in scenes.values())
+    print("INCREMENTAL BUILD COMPLETE: {} seconds.\nNUMBER OF SCENES IN TRAIN SET: {}\nNUMBER OF SCENES IN TEST SET: {}".format(round(time.time() - start_time, 2), len(scenes) - num_test, num_test))
+    print("Manifest:", manifest_path)
+
+    return manifest
 
 
 if __name__ == "__main__":
@@ -135,6 +431,10 @@ if __name__ == "__main__":
     test_to_train_ratio = 0.3 
     img_width = img_height = 256
     num_channels = 3
+    output_format = "files"
+    incremental = False
+    # Drops crops of the white padding and other textureless areas, see tile_filters.BackgroundFilter.
+    background_filter = BackgroundFilter()
 
     # Path Information
     images_path = root_data_path + "sat/"
@@ -142,12 +442,21 @@ if __name__ == "__main__":
     new_images_path = root_data_path + "Images/"
     new_masks_path = root_data_path + "Masks/"
 
-    for path in [new_images_path, new_masks_path]:
-        if not os.path.exists(path):
-            os.mkdir(path)
-            print("DIRECTORY CREATED: {}".format(path))
-        else:
-             print("DIRECTORY ALREADY EXISTS: {}".format(path))
+    if incremental:
+        # Only new or changed scenes are cropped, and the split is recorded in manifest.json, see load_split.
+        build_incremental(root_data_path, img_width, img_height, test_to_train_ratio, background_filter=background_filter)
+
+    elif output_format == "shards":
+        # The split is made when the shards are read, see shards.ShardDataset.split.
+        crop_and_save(images_path, masks_path, root_data_path + "Shards/", None, img_width, img_height, output_format=output_format, background_filter=background_filter)
+
+    else:
+        for path in [new_images_path, new_masks_path]:
+            if not os.path.exists(path):
+                os.mkdir(path)
+                print("DIRECTORY CREATED: {}".format(path))
+            else:
+                 print("DIRECTORY ALREADY EXISTS: {}".format(path))
 
-    crop_and_save(images_path, masks_path, new_image_path, new_mask_path, img_width, img_height)
-    train_test_split(new_images_path, new_masks_path, test_to_train_ratio)
\ No newline at end of file
+        crop_and_save(images_path, masks_path, new_images_path, new_masks_path, img_width, img_height, background_filter=background_filter)
+        train_test_split(new_images_path, new_masks_path, test_to_train_ratio)
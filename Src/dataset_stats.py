@@ -0,0 +1,208 @@
+"""
+Filename: dataset_stats.py
+
+Function: Computes the per-channel mean, standard deviation and covariance of the training crops in one streaming pass, for featurewise normalization and ZCA whitening without loading the dataset into memory.
+
+Author: Jerin Paul (https://github.com/Paulymorphous)
+Website: https://www.livetheaiexperience.com/
+"""
+
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import click
+import numpy as np
+
+from build_dataset import load_split, save_json
+from shards import ShardDataset
+
+STATS_FILE = "dataset_stats.json"
+
+
+def pixel_moments(images):
+    """
+    Moments of the pixels of a batch, taken as vectors of channel values.
+
+    Parameters
+    ----------
+    >images (numpy array): Batch of shape (n, height, width, channels).
+
+    Returns
+    ----------
+    > A tuple (number of pixels, mean of shape (channels,), sum of the outer products of the centred pixels, of shape (channels, channels)).
+    """
+
+    pixels = images.reshape(-1, images.shape[-1]).astype(np.float64)
+    mean = pixels.mean(axis=0)
+    centred = pixels - mean
+    return len(pixels), mean, centred.T @ centred
+
+
+def merge_moments(first, second):
+    """
+    Combines the moments of two sets of pixels into the moments of their union, as in Chan et al.'s parallel variance algorithm.
+    """
+
+    count_a, mean_a, m2_a = first
+    count_b, mean_b, m2_b = second
+    if count_a == 0:
+        return second
+    if count_b == 0:
+        return first
+
+    count = count_a + count_b
+    delta = mean_b - mean_a
+    mean = mean_a + delta * count_b / count
+    return count, mean, m2_a + m2_b + np.outer(delta, delta) * count_a * count_b / count
+
+
+def file_moments(image_paths):
+    # Moments of a chunk of crop files. Runs in the worker processes of compute_stats.
+    import cv2
+
+    moments = (0, 0., 0.)
+    for image_path in image_paths:
+        image = cv2.imread(image_path, cv2.IMREAD_COLOR)[..., ::-1]
+        moments = merge_moments(moments, pixel_moments(image[np.newaxis]))
+    return moments
+
+
+def shard_moments(positions, shards_path):
+    # Moments of a chunk of the crops of a ShardDataset. Runs in the worker processes of compute_stats.
+    # get_batch returns RGB, also for shards written in BGR before the index recorded a channel_order.
+    images, _ = ShardDataset(shards_path).get_batch(positions)
+    return pixel_moments(images)
+
+
+def compute_stats(image_paths=None, shards_path=None, test_split=0.3, num_workers=None, chunk_size=64):
+    """
+    Streams over the crops once and accumulates the moments of their pixels, in parallel over chunks of crops.
+
+    Please note:
+    > Only chunk_size crops per worker are in memory at a time, whatever the size of the dataset.
+    > Every chunk is reduced to its count, mean and centred sum of outer products, in float64, and the chunks are merged with merge_moments,
+      which stays accurate where summing raw squares would not.
+    > Statistics are computed on the raw 0-255 RGB values, the rescale of the config is applied when they are used, see featurewise_parameters.
+
+    Parameters
+    ----------
+    >image_paths (list): Paths to the image crops.
+    >shards_path (str): Directory of a ShardDataset, instead of image_paths. Only its train set is used.
+    >test_split (float): Ratio of the test set of the shards, see ShardDataset.split. Default: 0.3
+    >num_workers (int): Number of worker processes. Default: None, one per CPU. Use 1 to run in the current process.
+    >chunk_size (int): Number of crops per task. Default: 64.
+
+    Returns
+    ----------
+    > A dictionary with the number of images and pixels, the "channel_order" and the per-channel "mean", "std" and "covariance" as lists.
+    """
+
+    if shards_path is not None:
+        # The test set is the first test_split of the crops, see ShardDataset.split.
+        num_crops = len(ShardDataset(shards_path))
+        first_train = int(test_split * num_crops)
+        num_images = num_crops - first_train
+        chunks = [np.arange(start, min(start + chunk_size, num_crops)) for start in range(first_train, num_crops, chunk_size)]
+        worker = partial(shard_moments, shards_path=shards_path)
+    else:
+        num_images = len(image_paths)
+        chunks = [image_paths[start:start + chunk_size] for start in range(0, num_images, chunk_size)]
+        worker = file_moments
+
+    moments = (0, 0., 0.)
+    if num_workers == 1:
+        for chunk_moments in map(worker, chunks):
+            moments = merge_moments(moments, chunk_moments)
+    else:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            for chunk_moments in executor.map(worker, chunks):
+                moments = merge_moments(moments, chunk_moments)
+
+    count, mean, m2 = moments
+    if count == 0:
+        raise ValueError("No images to compute statistics on.")
+
+    covariance = m2 / count
+    return {"num_images": num_images, "num_pixels": int(count), "channel_order": "RGB", "mean": mean.tolist(),
+            "std": np.sqrt(np.diag(covariance)).tolist(), "covariance": covariance.tolist()}
+
+
+def load_stats(stats_path):
+    with open(stats_path, 'r') as stats_file:
+        stats = json.load(stats_file)
+    for key in ("mean", "std", "covariance"):
+        stats[key] = np.asarray(stats[key], dtype=np.float64)
+    return stats
+
+
+def featurewise_parameters(stats, settings):
+    """
+    Turns the dataset statistics into the featurewise steps of ImageDataGenerator.standardize, for images already rescaled.
+
+    Please note:
+    > As in ImageDataGenerator, zca_whitening implies featurewise_center, and the whitening matrix is computed on the centred, and
+      with featurewise_std_normalization normalized, data.
+    > The whitening is applied per pixel, across the colour channels. ImageDataGenerator whitens the whole flattened image, whose
+      covariance matrix for a 256x256x3 crop would have 196608^2 entries.
+
+    Parameters
+    ----------
+    >stats (dict): Output of load_stats.
+    >settings (dict): Output of augmentation.augmentation_settings.
+
+    Returns
+    ----------
+    > A dictionary with the float32 "mean" and "std" of shape (channels,) and the "zca" matrix of shape (channels, channels), each None when its step is off.
+    """
+
+    scale = settings["rescale"] or 1.
+    center = settings["featurewise_center"] or settings["zca_whitening"]
+    mean = stats["mean"] * scale
+    std = stats["std"] * scale + 1e-6
+
+    zca = None
+    if settings["zca_whitening"]:
+        sigma = stats["covariance"] * scale ** 2
+        if settings["featurewise_std_normalization"]:
+            sigma = sigma / np.outer(std, std)
+        u, s, _ = np.linalg.svd(sigma)
+        zca = (u @ np.diag(1. / np.sqrt(s + settings["zca_epsilon"])) @ u.T).astype(np.float32)
+
+    return {
+        "mean": mean.astype(np.float32) if center else None,
+        "std": std.astype(np.float32) if settings["featurewise_std_normalization"] else None,
+        "zca": zca,
+    }
+
+
+@click.command()
+@click.option('--crops_path', default="../Data/BuildingsDataSet/Train/", help="Train directory written by train_test_split.")
+@click.option('--manifest_path', default=None, help="manifest.json of an incremental build, its train split is used instead of crops_path.")
+@click.option('--shards_path', default=None, help="Directory of shards, used instead of crops_path.")
+@click.option('--test_split', default=0.3, help="Ratio of the test set of the shards.")
+@click.option('--output', default=None, help="File to write the statistics to. Default: dataset_stats.json next to the crops.")
+@click.option('--num_workers', default=None, type=int, help="Number of worker processes. Default: one per CPU.")
+def main(crops_path, manifest_path, shards_path, test_split, output, num_workers):
+
+    if shards_path is not None:
+        stats = compute_stats(shards_path=shards_path, test_split=test_split, num_workers=num_workers)
+        output = output or os.path.join(shards_path, STATS_FILE)
+    else:
+        if manifest_path is not None:
+            image_paths = [image_path for image_path, _ in load_split(manifest_path, "train")]
+            output = output or os.path.join(os.path.dirname(manifest_path), STATS_FILE)
+        else:
+            images_path = os.path.join(crops_path, "Images", "samples")
+            image_paths = [os.path.join(images_path, filename) for filename in sorted(os.listdir(images_path))]
+            output = output or os.path.join(crops_path, STATS_FILE)
+        stats = compute_stats(image_paths, num_workers=num_workers)
+
+    save_json(output, stats, indent=2)
+    print("Statistics of {} images saved to {}".format(stats["num_images"], output))
+    print("mean: {}\nstd: {}".format(np.round(stats["mean"], 3), np.round(stats["std"], 3)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,304 @@
+"""
+Filename: evaluate.py
+
+Function: Scores road predictions against the ground truth masks of a test set: dice, IoU, precision and recall per scene and overall, at several thresholds in a single pass.
+
+Author: Jerin Paul (https://github.com/Paulymorphous)
+Website: https://www.livetheaiexperience.com/
+"""
+
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import click
+import numpy as np
+
+from build_dataset import load_split
+from inference import MODEL_PATH, Predictor, prepare_image
+from postprocessing import rle_decode, unpack_mask
+
+THRESHOLDS = (0.05, 0.1, 0.25, 0.5)
+METRICS = ("dice", "iou", "precision", "recall")
+
+# Probabilities are quantized to 256 levels, the resolution of predictions saved as 8 bit images.
+LEVELS = 256
+PREDICTION_EXTENSIONS = ('.npy', '.npz', '.json', '.png', '.tif', '.tiff')
+
+
+def scene_of(crop_file):
+    """
+    Name of the source scene of a crop. Crops are written by build_dataset as <number>_<scene file>.
+    """
+
+    number, _, scene = crop_file.partition('_')
+    return scene if number.isdigit() and scene else crop_file
+
+
+def quantize(probabilities):
+    """
+    Maps probabilities in [0, 1], or uint8 predictions in [0, 255], to uint8 levels.
+    """
+
+    if probabilities.dtype == np.uint8:
+        return probabilities
+    return np.rint(np.clip(probabilities, 0, 1) * (LEVELS - 1)).astype(np.uint8)
+
+
+def confusion_histogram(truth, probabilities):
+    """
+    Counts the pixels of every (ground truth, probability level) pair with one bincount. Every threshold can be scored from this histogram, see confusion_counts.
+
+    Parameters
+    ----------
+    >truth (numpy array): Ground truth masks, roads are non zero.
+    >probabilities (numpy array): Predictions of the same number of pixels, see quantize.
+
+    Returns
+    ----------
+    > An int64 array of shape (2, LEVELS): row 0 counts the background pixels, row 1 the road pixels, per probability level.
+    """
+
+    if truth.size != probabilities.size:
+        raise ValueError("Prediction of shape {} does not match mask of shape {}".format(probabilities.shape, truth.shape))
+
+    index = (truth.ravel() > 0).astype(np.intp) * LEVELS + quantize(probabilities).ravel()
+    return np.bincount(index, minlength=2 * LEVELS).reshape(2, LEVELS)
+
+
+def confusion_counts(histogram, thresholds=THRESHOLDS):
+    """
+    True positives, false positives, false negatives and true negatives at every threshold, from a histogram of confusion_histogram.
+
+    Please note:
+    > A pixel is a road when its probability is above the threshold, as in postprocessing.threshold_batch, to a resolution of 1/255.
+
+    Returns
+    ----------
+    > A dictionary with "tp", "fp", "fn" and "tn" arrays, one value per threshold.
+    """
+
+    # Number of pixels at or above every level, per ground truth class.
+    above = np.cumsum(histogram[:, ::-1], axis=1)[:, ::-1]
+    above = np.concatenate([above, np.zeros((2, 1), dtype=above.dtype)], axis=1)
+    first_positive = np.floor(np.asarray(thresholds) * (LEVELS - 1)).astype(np.intp) + 1
+
+    tp, fp = above[1, first_positive], above[0, first_positive]
+    return {"tp": tp, "fp": fp, "fn": histogram[1].sum() - tp, "tn": histogram[0].sum() - fp}
+
+
+def scores(histogram, thresholds=THRESHOLDS):
+    """
+    Dice, IoU, precision and recall at every threshold. A score whose denominator is 0 (nothing to find and nothing found) is 1.
+
+    Returns
+    ----------
+    > A dictionary with one list per metric, one value per threshold.
+    """
+
+    counts = confusion_counts(histogram, thresholds)
+    tp, fp, fn = (counts[key].astype(np.float64) for key in ("tp", "fp", "fn"))
+
+    def ratio(numerator, denominator):
+        return np.where(denominator > 0, numerator / np.maximum(denominator, 1), 1.0).tolist()
+
+    return {
+        "dice": ratio(2 * tp, 2 * tp + fp + fn),
+        "iou": ratio(tp, tp + fp + fn),
+        "precision": ratio(tp, tp + fp),
+        "recall": ratio(tp, tp + fn),
+    }
+
+
+def load_prediction(path):
+    """
+    Reads a saved prediction: probabilities in a .npy file, a mask packed (.npz) or run-length encoded (.json) by batch_inference, or an 8 bit image.
+    """
+
+    import cv2
+
+    if path.endswith('.npy'):
+        return np.load(path)
+    if path.endswith('.npz'):
+        with np.load(path) as packed:
+            return unpack_mask({"bits": packed["bits"], "shape": tuple(packed["shape"])})
+    if path.endswith('.json'):
+        with open(path, 'r') as prediction_file:
+            encoded = json.load(prediction_file)
+        if not isinstance(encoded, dict) or "counts" not in encoded:
+            raise ValueError("Only run-length encoded predictions can be scored: {}".format(path))
+        return rle_decode(encoded)
+
+    prediction = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    if prediction is None:
+        raise ValueError("Could not read prediction: {}".format(path))
+    return prediction if prediction.ndim == 2 else prediction[..., 0]
+
+
+def find_prediction(predictions_path, mask_file):
+    stem = os.path.splitext(mask_file)[0]
+    for extension in PREDICTION_EXTENSIONS:
+        path = os.path.join(predictions_path, stem + extension)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def test_pairs(test_path=None, manifest_path=None):
+    """
+    Lists the (image path, mask path) pairs of a test set, from the Test/ directory of train_test_split or the test split of an incremental build.
+    """
+
+    if manifest_path is not None:
+        return load_split(manifest_path, "test")
+
+    images_path = os.path.join(test_path, "Images", "samples")
+    masks_path = os.path.join(test_path, "Masks", "samples")
+    return [(os.path.join(images_path, filename), os.path.join(masks_path, filename)) for filename in sorted(os.listdir(masks_path))]
+
+
+def score_file(mask_path, prediction_path):
+    """
+    Histogram of one ground truth mask and its saved prediction. Runs in the worker processes of evaluate_predictions.
+    """
+
+    import cv2
+
+    return confusion_histogram(cv2.imread(mask_path, 0), load_prediction(prediction_path))
+
+
+def evaluate_predictions(pairs, predictions_path, num_workers=None):
+    """
+    Accumulates the histograms of saved predictions, in parallel over the files.
+
+    Parameters
+    ----------
+    >pairs (list): (image path, mask path) tuples, see test_pairs.
+    >predictions_path (str): Directory with one prediction per mask, with the same name and any of PREDICTION_EXTENSIONS.
+    >num_workers (int): Number of worker processes. Default: None, one per CPU.
+
+    Returns
+    ----------
+    > A dictionary of histograms per scene, and the list of masks without a prediction.
+    """
+
+    histograms, missing, jobs = {}, [], []
+    for _, mask_path in pairs:
+        prediction_path = find_prediction(predictions_path, os.path.basename(mask_path))
+        if prediction_path is None:
+            missing.append(mask_path)
+        else:
+            jobs.append((mask_path, prediction_path))
+
+    if jobs:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            mask_paths, prediction_paths = zip(*jobs)
+            for mask_path, histogram in zip(mask_paths, executor.map(score_file, mask_paths, prediction_paths, chunksize=16)):
+                scene = scene_of(os.path.basename(mask_path))
+                histograms[scene] = histograms.get(scene, 0) + histogram
+
+    return histograms, missing
+
+
+def evaluate_model(pairs, predictor, batch_size=32, num_workers=None):
+    """
+    Predicts the test images with a model and accumulates the histograms batch by batch, so no prediction is kept in memory.
+
+    Please note:
+    > Images and masks are read by a pool of num_workers threads while the model runs.
+
+    Parameters
+    ----------
+    >pairs (list): (image path, mask path) tuples, see test_pairs.
+    >predictor (inference.Predictor): Loaded model.
+    >batch_size (int): Number of images per call to the model. Default: 32.
+    >num_workers (int): Number of reading threads. Default: None, as chosen by ThreadPoolExecutor.
+
+    Returns
+    ----------
+    > A dictionary of histograms per scene, and an empty list of missing predictions.
+    """
+
+    import cv2
+
+    def read(pair):
+        image_path, mask_path = pair
+        image = cv2.imread(image_path, cv2.IMREAD_COLOR)[..., ::-1]
+        return prepare_image(image)[0], cv2.imread(mask_path, 0)
+
+    histograms = {}
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        for start in range(0, len(pairs), batch_size):
+            batch_pairs = pairs[start:start + batch_size]
+            images, masks = zip(*executor.map(read, batch_pairs))
+            preds = predictor.predict_batch(np.stack(images), batch_size)[..., 0]
+
+            for (_, mask_path), mask, pred in zip(batch_pairs, masks, preds):
+                if pred.shape != mask.shape:
+                    pred = cv2.resize(pred, (mask.shape[1], mask.shape[0]), interpolation=cv2.INTER_LINEAR)
+                scene = scene_of(os.path.basename(mask_path))
+                histograms[scene] = histograms.get(scene, 0) + confusion_histogram(mask, pred)
+
+    return histograms, []
+
+
+def report(histograms, thresholds=THRESHOLDS):
+    """
+    Scores every scene, and all scenes together from the summed histograms, so the global scores weigh every pixel equally.
+
+    Returns
+    ----------
+    > A dictionary with the "thresholds", the "global" scores and the scores of every scene in "scenes".
+    """
+
+    total = sum(histograms.values()) if histograms else np.zeros((2, LEVELS), dtype=np.int64)
+    return {
+        "thresholds": list(thresholds),
+        "global": scores(total, thresholds),
+        "scenes": {scene: scores(histograms[scene], thresholds) for scene in sorted(histograms)},
+    }
+
+
+def print_report(results):
+    header = "{:<32}".format("scene / threshold") + "".join("{:>10}".format(metric) for metric in METRICS)
+    print(header)
+    print("-" * len(header))
+    for name, scene_scores in list(results["scenes"].items()) + [("GLOBAL", results["global"])]:
+        for n, threshold in enumerate(results["thresholds"]):
+            label = "{} @ {}".format(name[:22], threshold)
+            print("{:<32}".format(label) + "".join("{:>10.4f}".format(scene_scores[metric][n]) for metric in METRICS))
+
+
+@click.command()
+@click.option('--test_path', default="../Data/BuildingsDataSet/Test/", help="Test directory written by train_test_split.")
+@click.option('--manifest_path', default=None, help="manifest.json of an incremental build, its test split is used instead of test_path.")
+@click.option('--predictions_path', default=None, help="Directory with saved predictions. Default: predict the test images with model_path.")
+@click.option('--model_path', default=MODEL_PATH, help="Path to the saved model.")
+@click.option('--thresholds', default=",".join(str(threshold) for threshold in THRESHOLDS), help="Comma separated thresholds.")
+@click.option('--batch_size', default=32, help="Number of images per call to the model.")
+@click.option('--num_workers', default=None, type=int, help="Number of parallel readers.")
+@click.option('--output', default=None, help="File to write the scores to as JSON.")
+def main(test_path, manifest_path, predictions_path, model_path, thresholds, batch_size, num_workers, output):
+
+    thresholds = [float(threshold) for threshold in thresholds.split(",")]
+    pairs = test_pairs(test_path, manifest_path)
+    print("{} test masks found.".format(len(pairs)))
+
+    if predictions_path is not None:
+        histograms, missing = evaluate_predictions(pairs, predictions_path, num_workers)
+    else:
+        histograms, missing = evaluate_model(pairs, Predictor(model_path), batch_size, num_workers)
+
+    for mask_path in missing:
+        print("MISSING PREDICTION: {}".format(mask_path))
+
+    results = report(histograms, thresholds)
+    print_report(results)
+
+    if output is not None:
+        with open(output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
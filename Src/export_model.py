@@ -0,0 +1,199 @@
+"""
+Filename: export_model.py
+
+Function: Exports the trained road model to TensorFlow Lite with float16 or int8 post-training quantization for CPU serving, and reports the dice and the speed of every variant on held-out crops.
+
+Author: Jerin Paul (https://github.com/Paulymorphous)
+Website: https://www.livetheaiexperience.com/
+"""
+
+import json
+import os
+import time
+
+import click
+import numpy as np
+
+from build_dataset import load_split
+from evaluate import evaluate_model, report, test_pairs
+from inference import MODEL_PATH, Predictor, load_serving_model, prepare_image
+from postprocessing import THRESHOLD
+
+QUANTIZATIONS = ("float32", "float16", "int8")
+
+
+def crop_images(crops_path=None, manifest_path=None, split="train"):
+    """
+    Lists the image crops of one split, from the Train/ or Test/ directory of train_test_split or from the manifest of an incremental build.
+    """
+
+    if manifest_path is not None:
+        return [image_path for image_path, _ in load_split(manifest_path, split)]
+
+    images_path = os.path.join(crops_path, "Images", "samples")
+    return [os.path.join(images_path, filename) for filename in sorted(os.listdir(images_path))]
+
+
+def calibration_images(image_paths, num_samples=200, seed=42):
+    """
+    Draws a random sample of crops and prepares them like inference does, to calibrate the int8 quantization.
+
+    Returns
+    ----------
+    > A float32 array of shape (num_samples, IMG_HEIGHT, IMG_WIDTH, CHANNELS).
+    """
+
+    import cv2
+
+    random_state = np.random.RandomState(seed)
+    selected = random_state.choice(len(image_paths), min(num_samples, len(image_paths)), replace=False)
+    return np.stack([prepare_image(cv2.imread(image_paths[n], cv2.IMREAD_COLOR)[..., ::-1])[0] for n in selected]).astype('float32')
+
+
+def convert(model, quantization="float16", calibration=None):
+    """
+    Converts a Keras model to TensorFlow Lite.
+
+    Please note:
+    > "float16" stores the weights as float16 and halves the file. "int8" quantizes weights and activations, with the ranges of the
+      activations measured on the calibration images. Ops without an int8 kernel stay in float32.
+    > Inputs and outputs stay float32 in every variant, see inference.TFLiteModel.
+
+    Parameters
+    ----------
+    >model (keras Model): Trained model.
+    >quantization (str): "float32", "float16" or "int8". Default: "float16".
+    >calibration (numpy array): Prepared images, required for "int8". See calibration_images.
+
+    Returns
+    ----------
+    > The TensorFlow Lite model as bytes.
+    """
+
+    import tensorflow as tf
+
+    if quantization not in QUANTIZATIONS:
+        raise ValueError("Unknown quantization: {}, expected one of {}".format(quantization, QUANTIZATIONS))
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+
+    if quantization == "float16":
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+
+    elif quantization == "int8":
+        if calibration is None or not len(calibration):
+            raise ValueError("int8 quantization needs calibration images.")
+
+        def representative_dataset():
+            for image in calibration:
+                yield [image[np.newaxis]]
+
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = representative_dataset
+
+    return converter.convert()
+
+
+def export_model(model_path, output_directory, quantizations=("float16", "int8"), calibration=None):
+    """
+    Writes one .tflite file per quantization next to each other, named after the source model.
+
+    Returns
+    ----------
+    > A dictionary with the path of every exported variant.
+    """
+
+    model = load_serving_model(model_path)
+    os.makedirs(output_directory, exist_ok=True)
+    name = os.path.splitext(os.path.basename(model_path))[0]
+
+    paths = {}
+    for quantization in quantizations:
+        path = os.path.join(output_directory, "{}_{}.tflite".format(name, quantization))
+        with open(path, 'wb') as output_file:
+            output_file.write(convert(model, quantization, calibration))
+        paths[quantization] = path
+        print("EXPORTED: {} ({} MB)".format(path, round(os.path.getsize(path) / 2 ** 20, 2)))
+    return paths
+
+
+def throughput(predictor, images, batch_size=32, num_batches=10):
+    # Images per second of predict_batch, after one untimed batch.
+    batch = images[:batch_size]
+    predictor.predict_batch(batch, batch_size)
+
+    start_time = time.perf_counter()
+    for _ in range(num_batches):
+        predictor.predict_batch(batch, batch_size)
+    return len(batch) * num_batches / (time.perf_counter() - start_time)
+
+
+def compare_variants(model_paths, pairs, batch_size=32, num_batches=10, threshold=THRESHOLD):
+    """
+    Scores every variant on the same held-out crops and measures its speed on the same batch.
+
+    Parameters
+    ----------
+    >model_paths (dict): Path of every variant, by name. Keras and .tflite files can be mixed.
+    >pairs (list): Held-out (image path, mask path) tuples, see evaluate.test_pairs.
+    >batch_size (int): Batch size of the predictions and of the speed test. Default: 32.
+    >num_batches (int): Number of timed batches. Default: 10.
+    >threshold (float): Threshold of the reported dice and IoU. Default: 0.05.
+
+    Returns
+    ----------
+    > A dictionary with the dice, IoU, images/sec and file size of every variant.
+    """
+
+    import cv2
+
+    images = np.stack([prepare_image(cv2.imread(image_path, cv2.IMREAD_COLOR)[..., ::-1])[0] for image_path, _ in pairs[:batch_size]])
+
+    results = {}
+    for name, model_path in model_paths.items():
+        predictor = Predictor(model_path)
+        histograms, _ = evaluate_model(pairs, predictor, batch_size)
+        scores = report(histograms, [threshold])["global"]
+        results[name] = {
+            "dice": scores["dice"][0],
+            "iou": scores["iou"][0],
+            "images_per_sec": throughput(predictor, images, batch_size, num_batches),
+            "size_mb": os.path.getsize(model_path) / 2 ** 20,
+        }
+
+    print("{:<10}{:>10}{:>10}{:>16}{:>10}".format("variant", "dice", "iou", "images/sec", "MB"))
+    for name, result in results.items():
+        print("{:<10}{:>10.4f}{:>10.4f}{:>16.1f}{:>10.2f}".format(name, result["dice"], result["iou"], result["images_per_sec"], result["size_mb"]))
+    return results
+
+
+@click.command()
+@click.option('--model_path', default=MODEL_PATH, help="Path to the trained Keras model.")
+@click.option('--output_directory', default="./Models/", help="Directory to write the .tflite files to.")
+@click.option('--quantizations', default="float16,int8", help="Comma separated variants: float32, float16, int8.")
+@click.option('--train_path', default="../Data/BuildingsDataSet/Train/", help="Train directory of train_test_split, crops are drawn from it for calibration.")
+@click.option('--test_path', default="../Data/BuildingsDataSet/Test/", help="Test directory of train_test_split, used for the report.")
+@click.option('--manifest_path', default=None, help="manifest.json of an incremental build, used instead of train_path and test_path.")
+@click.option('--num_calibration', default=200, help="Number of crops used to calibrate int8.")
+@click.option('--num_eval', default=500, help="Maximum number of held-out crops in the report.")
+@click.option('--batch_size', default=32, help="Batch size of the report.")
+@click.option('--report', 'report_path', default=None, help="File to write the report to as JSON. Default: no report.")
+def main(model_path, output_directory, quantizations, train_path, test_path, manifest_path, num_calibration, num_eval, batch_size, report_path):
+
+    quantizations = quantizations.split(",")
+    calibration = None
+    if "int8" in quantizations:
+        calibration = calibration_images(crop_images(train_path, manifest_path, "train"), num_calibration)
+
+    model_paths = {"keras": model_path}
+    model_paths.update(export_model(model_path, output_directory, quantizations, calibration))
+
+    if report_path is not None:
+        pairs = test_pairs(test_path, manifest_path)[:num_eval]
+        with open(report_path, 'w') as output_file:
+            json.dump(compare_variants(model_paths, pairs, batch_size), output_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,17 +7,96 @@ Author: Jerin Paul (https://github.com/Paulymorphous)
 Website: https://www.livetheaiexperience.com/
 """
 
-from keras.preprocessing.image import ImageDataGenerator
+import numpy as np
+from augmentation import PairedAugmenter, augmentation_settings, featurewise_steps, GEOMETRIC_SETTINGS
+from dataset_stats import load_stats
+from shards import ShardDataset
+from build_dataset import load_split
+import os
+import math
 
-def GetDataGenerators(augmentation_parameters, train_images_path=None, train_targets_path=None, test_images_path=None, test_targets_path=None, batch_size = 64, seed=42):
+# TensorFlow is only imported by the tf.data pipeline functions, the NumPy generators do not need it.
+# OpenCV is imported by the functions that decode files.
+
+# Extensions that tf.io.decode_image can read, anything else (like the .tiff crops) is decoded with OpenCV.
+TF_DECODABLE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.gif')
+
+
+def list_image_pairs(images_path, targets_path):
+    """
+    Lists the image and mask files in the flow_from_directory layout: files in the sub folders of the given folders.
+    Images and masks are paired by sub folder and file name, not by their position in the listing.
+
+    Returns
+    ----------
+    > A sorted list of (image path, mask path) tuples.
+    """
+
+    pairs = []
+    for subdir in sorted(os.listdir(images_path)):
+        image_dir = os.path.join(images_path, subdir)
+        mask_dir = os.path.join(targets_path, subdir)
+        if not os.path.isdir(image_dir) or not os.path.isdir(mask_dir):
+            continue
+
+        mask_files = set(os.listdir(mask_dir))
+        for filename in sorted(os.listdir(image_dir)):
+            if filename in mask_files:
+                pairs.append((os.path.join(image_dir, filename), os.path.join(mask_dir, filename)))
+    return pairs
+
+
+def image_pair_lists(train_images_path, train_targets_path, test_images_path, test_targets_path, manifest_path):
+    # Train and test (image path, mask path) lists, from the manifest if there is one and from the folders otherwise.
+    if manifest_path:
+        return load_split(manifest_path, "train"), load_split(manifest_path, "test")
+
+    train_pairs = list_image_pairs(train_images_path, train_targets_path) if train_images_path and train_targets_path else None
+    test_pairs = list_image_pairs(test_images_path, test_targets_path) if test_images_path and test_targets_path else None
+    return train_pairs, test_pairs
+
+
+def read_image_pairs(pairs):
+    """
+    Decodes a list of (image path, mask path) pairs into one uint8 batch of RGB images and one of grayscale masks.
     """
-        Builds and returns ImageDataGenerators based on the paths that are sepcified. 
+
+    import cv2
+
+    images = np.stack([cv2.imread(image_path, cv2.IMREAD_COLOR)[..., ::-1] for image_path, _ in pairs])
+    masks = np.stack([cv2.imread(mask_path, cv2.IMREAD_GRAYSCALE) for _, mask_path in pairs])
+    return images, masks
+
+
+def paired_batches(pairs, augmenter, batch_size, shuffle=True, seed=42):
+    """
+    Endless generator of augmented (images, masks) batches from a list of file pairs, reshuffled every epoch like flow_from_directory.
+    Raises a ValueError on the first batch when there are no pairs, for example for the validation set of a validation_split of 0.
+    """
+
+    if not len(pairs):
+        raise ValueError("No image pairs to draw batches from, check the data paths and validation_split.")
+
+    random_state = np.random.RandomState(seed)
+    while True:
+        order = random_state.permutation(len(pairs)) if shuffle else np.arange(len(pairs))
+        for start in range(0, len(order), batch_size):
+            yield augmenter(*read_image_pairs([pairs[i] for i in order[start:start + batch_size]]))
+
+
+def GetDataGenerators(augmentation_parameters, train_images_path=None, train_targets_path=None, test_images_path=None, test_targets_path=None, batch_size = 64, seed=42, manifest_path=None,
+                      stats_path=None):
+    """
+        Builds and returns data generators based on the paths that are sepcified.
 
         Please note:
-        > Since this is not a multi-class classification problem and ImageDataGenerators require atleast one folder with images in it, we provide the path to the parent directory of the folder containting the images.
+        > Since this is not a multi-class classification problem and flow_from_directory requires atleast one folder with images in it, we provide the path to the parent directory of the folder containting the images. The same layout is kept here.
         > If you want only one type of data generator, then you need to provide the path only for that dataset. See Example for clarification.
-        > A Validation generator is also returned with the Train generator.
+        > A Validation generator is also returned with the Train generator. It holds the first "validation_split" of the sorted training files, like the 'validation' subset of flow_from_directory.
         > You can modify the parameters for Image Augmentation in the Config File.
+        > Every image is paired with the mask of the same file name and both are read once and augmented together by a PairedAugmenter, so they can never go out of step.
+          Masks are binarized to 0 and 1 and have one channel. The Test generator is not randomly transformed.
+        > Instead of the folders, the train and test sets of an incremental build can be read from its manifest (see build_dataset.build_incremental).
 
         Read more about the prerocessing methods here: https://keras.io/api/preprocessing/image/
 
@@ -30,6 +109,8 @@ def GetDataGenerators(augmentation_parameters, train_images_path=None, train_tar
         >test_targets_path (str): Path to the parent folder of the folder containting Test Masks.
         >batch_size (int): Desired batch size for the datagenerators. Default: 64.
         >seed (int): this number seeds the Datagenerators. Default: 42, because its the answer to everything ;)
+        >manifest_path (str): Path to the manifest.json of an incremental build. Replaces the four folder paths. Default: None.
+        >stats_path (str): Statistics written by dataset_stats.py, needed by the featurewise options of the config. Default: None.
 
         Returns
         ----------
@@ -45,125 +126,281 @@ def GetDataGenerators(augmentation_parameters, train_images_path=None, train_tar
     """
 
     generators = []
+    settings = augmentation_settings(augmentation_parameters)
+    stats = load_stats(stats_path) if stats_path else None
+
+    train_pairs, test_pairs = image_pair_lists(train_images_path, train_targets_path, test_images_path, test_targets_path, manifest_path)
+
+    if train_pairs:
+
+        validation_set_size = int(float(augmentation_parameters["validation_split"]) * len(train_pairs))
+
+        train_generator = paired_batches(train_pairs[validation_set_size:], PairedAugmenter(settings, seed, stats=stats), batch_size, shuffle=True, seed=seed)
+        validation_generator = paired_batches(train_pairs[:validation_set_size], PairedAugmenter(settings, seed, stats=stats), batch_size, shuffle=True, seed=seed)
 
-    def get_boolean(string):
-        if string == "True":
-            return True
-        elif string == "False":
-            return False
-       
-    if train_images_path and  train_targets_path:
-
-        train_datagen = ImageDataGenerator(
-                                            featurewise_center=get_boolean(augmentation_parameters["featurewise_center"]),
-                                            samplewise_center=get_boolean(augmentation_parameters["samplewise_center"]),
-                                            featurewise_std_normalization=get_boolean(augmentation_parameters["featurewise_std_normalization"]),
-                                            samplewise_std_normalization=get_boolean(augmentation_parameters["samplewise_std_normalization"]),
-                                            zca_whitening=get_boolean(augmentation_parameters["zca_whitening"]),
-                                            zca_epsilon=float(augmentation_parameters["zca_epsilon"]),
-                                            rotation_range=float(augmentation_parameters["rotation_range"]),
-                                            width_shift_range=float(augmentation_parameters["width_shift_range"]),
-                                            height_shift_range=float(augmentation_parameters["height_shift_range"]),
-                                            shear_range=float(augmentation_parameters["shear_range"]),
-                                            zoom_range=float(augmentation_parameters["zoom_range"]),
-                                            channel_shift_range=float(augmentation_parameters["channel_shift_range"]),
-                                            fill_mode=augmentation_parameters["fill_mode"],
-                                            cval=float(augmentation_parameters["cval"]),
-                                            horizontal_flip=get_boolean(augmentation_parameters["horizontal_flip"]),
-                                            vertical_flip=get_boolean(augmentation_parameters["vertical_flip"]),
-                                            rescale=float(augmentation_parameters["rescale"]),
-                                            validation_split = float(augmentation_parameters["validation_split"])
-                                           )
-
-        train_image_generator = train_datagen.flow_from_directory(
-                                                                 directory = train_images_path,
-                                                                 batch_size = batch_size,
-                                                                 class_mode=None,
-                                                                 subset = 'training',
-                                                                 seed = seed
-                                                                )
-
-        train_target_generator = train_datagen.flow_from_directory(
-                                                                 directory = train_targets_path,
-                                                                 batch_size = batch_size,
-                                                                 class_mode=None,
-                                                                 subset = 'training',
-                                                                 seed = seed
-                                                                )
-
-
-        validation_image_generator = train_datagen.flow_from_directory( 
-                                                                           directory = train_images_path,
-                                                                           batch_size = batch_size,
-                                                                           class_mode=None,
-                                                                           subset = 'validation',
-                                                                           seed = seed
-                                                                      )
-
-        validation_target_generator = train_datagen.flow_from_directory( 
-                                                                           directory = train_targets_path,
-                                                                           batch_size = batch_size,
-                                                                           class_mode=None,
-                                                                           subset = 'validation',
-                                                                           seed = seed,
-                                                                    )
-
-        train_generator = zip(train_image_generator, train_target_generator)
-        validation_generator = zip(validation_image_generator, validation_target_generator)
-        
         generators.extend([train_generator, validation_generator])
-    
-    
-    if test_images_path and  test_targets_path:
-        
-    
-        test_datagen = ImageDataGeneratorImageDataGenerator(
-                                            featurewise_center=get_boolean(augmentation_parameters["featurewise_center"]),
-                                            samplewise_center=get_boolean(augmentation_parameters["samplewise_center"]),
-                                            featurewise_std_normalization=get_boolean(augmentation_parameters["featurewise_std_normalization"]),
-                                            samplewise_std_normalization=get_boolean(augmentation_parameters["samplewise_std_normalization"]),
-                                            zca_whitening=get_boolean(augmentation_parameters["zca_whitening"]),
-                                            zca_epsilon=float(augmentation_parameters["zca_epsilon"]),
-                                            rotation_range=float(augmentation_parameters["rotation_range"]),
-                                            width_shift_range=float(augmentation_parameters["width_shift_range"]),
-                                            height_shift_range=float(augmentation_parameters["height_shift_range"]),
-                                            shear_range=float(augmentation_parameters["shear_range"]),
-                                            zoom_range=float(augmentation_parameters["zoom_range"]),
-                                            channel_shift_range=float(augmentation_parameters["channel_shift_range"]),
-                                            fill_mode=augmentation_parameters["fill_mode"],
-                                            cval=float(augmentation_parameters["cval"]),
-                                            horizontal_flip=get_boolean(augmentation_parameters["horizontal_flip"]),
-                                            vertical_flip=get_boolean(augmentation_parameters["vertical_flip"]),
-                                            rescale=float(augmentation_parameters["rescale"]),
-                                            validation_split = float(augmentation_parameters["validation_split"])
-                                           )
-
-
-        test_image_generator = test_datagen.flow_from_directory(
-                                                                  directory = test_images_path,
-                                                                  batch_size = batch_size,
-                                                                  class_mode=None,
-                                                                  shuffle = False,
-                                                                  seed = seed
-                                                              )
-
-
-        test_target_generator = test_datagen.flow_from_directory(
-                                                                  directory = test_targets_path,
-                                                                  batch_size = batch_size,
-                                                                  class_mode=None,
-                                                                  shuffle = False,
-                                                                  seed = seed
-                                                              )
-        
-        test_generator = zip(test_image_generator, test_target_generator)
+
+
+    if test_pairs:
+
+        test_generator = paired_batches(test_pairs, PairedAugmenter(settings, seed, random_transforms=False, stats=stats), batch_size, shuffle=False)
 
         generators.append(test_generator)
-    
+
     if generators:
-        
+
         return generators
-    
+
+    else:
+        print("Invalid Input for Data Paths. Plese Check and Retry.")
+        return None
+
+
+def shard_batches(dataset, batch_size, augmenter, shuffle=True, seed=42):
+    """
+    Endless generator of augmented (images, masks) batches from a ShardDataset, reshuffled every epoch like flow_from_directory.
+
+    Please note:
+    > Every batch is read with one fancy index per shard, sorted so the memory maps are read in order.
+    > Raises a ValueError on the first batch when the dataset is empty, for example for the validation set of a validation_split of 0.
+    """
+
+    if not len(dataset):
+        raise ValueError("No crops to draw batches from, check the shards, test_split and validation_split.")
+
+    random_state = np.random.RandomState(seed)
+    while True:
+        order = random_state.permutation(len(dataset)) if shuffle else np.arange(len(dataset))
+        for start in range(0, len(order), batch_size):
+            yield augmenter(*dataset.get_batch(np.sort(order[start:start + batch_size])))
+
+
+def GetShardGenerators(augmentation_parameters, shards_path, test_split=0.3, batch_size = 64, seed=42, stats_path=None):
+    """
+        Builds and returns data generators that read crops packed by build_dataset.crop_and_save(output_format="shards").
+
+        Please note:
+        > The crops are read straight from memory mapped shards, in random order, so there are no per crop files to open.
+        > The first test_split of the crops are the test set, the same split train_test_split makes. The rest is divided into train and validation sets with "validation_split" from the config.
+        > Batches are augmented like in GetDataGenerators.
+
+        Parameters
+        ----------
+        >augmentation_parameters (Object of ConfigParser SectionProxy): Configurations from for Augmentation.
+        >shards_path (str): Path to the directory with the shards and their index.
+        >test_split (float): Ratio of the size of the test set to the entire dataset. Default: 0.3
+        >batch_size (int): Desired batch size for the datagenerators. Default: 64.
+        >seed (int): this number seeds the shuffling. Default: 42.
+        >stats_path (str): Statistics written by dataset_stats.py, needed by the featurewise options of the config. Default: None.
+
+        Returns
+        ----------
+        > A list with the Train data generator, the validation data generator and the Test data generator.
+    """
+
+    settings = augmentation_settings(augmentation_parameters)
+    stats = load_stats(stats_path) if stats_path else None
+    validation_split = float(augmentation_parameters["validation_split"])
+
+    train_set, test_set = ShardDataset(shards_path).split(test_split)
+    validation_set_size = int(validation_split * len(train_set))
+    validation_set = train_set.subset(np.arange(validation_set_size))
+    train_set = train_set.subset(np.arange(validation_set_size, len(train_set)))
+
+    return [
+        shard_batches(train_set, batch_size, PairedAugmenter(settings, seed, stats=stats), shuffle=True, seed=seed),
+        shard_batches(validation_set, batch_size, PairedAugmenter(settings, seed, stats=stats), shuffle=True, seed=seed),
+        shard_batches(test_set, batch_size, PairedAugmenter(settings, seed, random_transforms=False, stats=stats), shuffle=False),
+    ]
+
+
+def _read_pair(image_path, mask_path):
+    # OpenCV reads BGR, the model was trained on RGB.
+    import cv2
+
+    image = cv2.imread(image_path.decode(), cv2.IMREAD_COLOR)[..., ::-1]
+    mask = cv2.imread(mask_path.decode(), cv2.IMREAD_GRAYSCALE)
+    return np.ascontiguousarray(image), mask
+
+
+def _decode_pair(image_path, mask_path, tf_decodable, target_size):
+    import tensorflow as tf
+
+    if tf_decodable:
+        image = tf.io.decode_image(tf.io.read_file(image_path), channels=3, expand_animations=False)
+        mask = tf.io.decode_image(tf.io.read_file(mask_path), channels=1, expand_animations=False)[..., 0]
+    else:
+        image, mask = tf.numpy_function(_read_pair, [image_path, mask_path], [tf.uint8, tf.uint8])
+
+    image.set_shape(tuple(target_size) + (3,))
+    mask.set_shape(tuple(target_size))
+    return image, mask
+
+
+def _random_transforms(num_samples, height, width, settings, seed):
+    """
+    Graph version of augmentation.sample_transforms: one set of projective transform parameters per sample of a batch, flips included.
+    """
+
+    import tensorflow as tf
+
+    def uniform(bound, offset):
+        return tf.random.uniform([num_samples], -bound, bound, seed=seed + offset)
+
+    theta = uniform(settings["rotation_range"], 1) * math.pi / 180
+    shear = uniform(settings["shear_range"], 2) * math.pi / 180
+    zoom_x = 1 + uniform(settings["zoom_range"], 3)
+    zoom_y = 1 + uniform(settings["zoom_range"], 4)
+
+    width_shift, height_shift = settings["width_shift_range"], settings["height_shift_range"]
+    shift_x = uniform(width_shift, 5) * (width if width_shift < 1 else 1)
+    shift_y = uniform(height_shift, 6) * (height if height_shift < 1 else 1)
+
+    cos, sin = tf.cos(theta), tf.sin(theta)
+    a0 = cos * zoom_x
+    a1 = (-cos * tf.sin(shear) - sin * tf.cos(shear)) * zoom_y
+    b0 = sin * zoom_x
+    b1 = (-sin * tf.sin(shear) + cos * tf.cos(shear)) * zoom_y
+
+    center_x, center_y = (width - 1) / 2, (height - 1) / 2
+    a2 = center_x - a0 * center_x - a1 * center_y + shift_x
+    b2 = center_y - b0 * center_x - b1 * center_y + shift_y
+
+    # A flip mirrors the output coordinates before they go through the matrix.
+    if settings["horizontal_flip"]:
+        flip = tf.cast(tf.random.uniform([num_samples], seed=seed + 7) < 0.5, tf.float32)
+        a2, b2 = a2 + flip * a0 * (width - 1), b2 + flip * b0 * (width - 1)
+        a0, b0 = a0 * (1 - 2 * flip), b0 * (1 - 2 * flip)
+    if settings["vertical_flip"]:
+        flip = tf.cast(tf.random.uniform([num_samples], seed=seed + 8) < 0.5, tf.float32)
+        a2, b2 = a2 + flip * a1 * (height - 1), b2 + flip * b1 * (height - 1)
+        a1, b1 = a1 * (1 - 2 * flip), b1 * (1 - 2 * flip)
+
+    zeros = tf.zeros([num_samples])
+    return tf.stack([a0, a1, a2, b0, b1, b2, zeros, zeros], axis=1)
+
+
+def _augment_batch(images, masks, settings, seed, random_transforms, featurewise):
+    """
+    Augments a batch with one random transform per sample, shared by every image and its mask.
+    Images are interpolated bilinearly, masks with nearest neighbour and no intensity changes, like PairedAugmenter.
+    """
+
+    import tensorflow as tf
+
+    height, width = images.shape[1], images.shape[2]
+    images = tf.cast(images, tf.float32)
+    masks = tf.cast(masks > 0, tf.float32)[..., tf.newaxis]
+
+    if random_transforms and any(settings[key] for key in GEOMETRIC_SETTINGS):
+        transforms = _random_transforms(tf.shape(images)[0], height, width, settings, seed)
+        fill_mode = settings["fill_mode"].upper()
+        images = tf.raw_ops.ImageProjectiveTransformV3(images=images, transforms=transforms, output_shape=[height, width],
+                                                       fill_value=settings["cval"], interpolation="BILINEAR", fill_mode=fill_mode)
+        masks = tf.raw_ops.ImageProjectiveTransformV3(images=masks, transforms=transforms, output_shape=[height, width],
+                                                      fill_value=0., interpolation="NEAREST", fill_mode=fill_mode)
+
+    if random_transforms and settings["channel_shift_range"]:
+        shifts = tf.random.uniform([tf.shape(images)[0], 1, 1, 1], -settings["channel_shift_range"], settings["channel_shift_range"], seed=seed + 9)
+        images = tf.clip_by_value(images + shifts, tf.reduce_min(images, axis=[1, 2, 3], keepdims=True), tf.reduce_max(images, axis=[1, 2, 3], keepdims=True))
+
+    if settings["rescale"]:
+        images = images * settings["rescale"]
+    if settings["samplewise_center"]:
+        images = images - tf.reduce_mean(images, axis=[1, 2, 3], keepdims=True)
+    if settings["samplewise_std_normalization"]:
+        images = images / (tf.math.reduce_std(images, axis=[1, 2, 3], keepdims=True) + 1e-6)
+
+    if featurewise["mean"] is not None:
+        images = images - featurewise["mean"]
+    if featurewise["std"] is not None:
+        images = images / featurewise["std"]
+    if featurewise["zca"] is not None:
+        images = tf.tensordot(images, featurewise["zca"], axes=[[3], [0]])
+
+    return images, masks
+
+
+def _build_dataset(pairs, settings, featurewise, batch_size, seed, training, cache, shuffle_buffer, target_size):
+    import tensorflow as tf
+
+    image_paths = [image_path for image_path, _ in pairs]
+    mask_paths = [mask_path for _, mask_path in pairs]
+    tf_decodable = all(os.path.splitext(path)[1].lower() in TF_DECODABLE_EXTENSIONS for path in image_paths + mask_paths)
+
+    # Typed explicitly, an empty list would be taken for floats.
+    dataset = tf.data.Dataset.from_tensor_slices((tf.constant(image_paths, dtype=tf.string), tf.constant(mask_paths, dtype=tf.string)))
+
+    # Shuffling the file names is free and covers the whole dataset. A cached dataset is shuffled after the cache,
+    # otherwise the order of the first epoch would be frozen into it. An empty split, like the validation set of a
+    # validation_split of 0, gives an empty dataset, shuffle does not accept a buffer of 0.
+    if training and not cache:
+        dataset = dataset.shuffle(max(len(pairs), 1), seed=seed, reshuffle_each_iteration=True)
+
+    dataset = dataset.map(lambda image_path, mask_path: _decode_pair(image_path, mask_path, tf_decodable, target_size),
+                          num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+    if cache:
+        dataset = dataset.cache("" if cache is True else cache)
+        if training:
+            dataset = dataset.shuffle(shuffle_buffer, seed=seed, reshuffle_each_iteration=True)
+
+    dataset = dataset.batch(batch_size)
+    dataset = dataset.map(lambda images, masks: _augment_batch(images, masks, settings, seed, training, featurewise),
+                          num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+    return dataset.prefetch(tf.data.experimental.AUTOTUNE)
+
+
+def GetTFDataPipelines(augmentation_parameters, train_images_path=None, train_targets_path=None, test_images_path=None, test_targets_path=None, batch_size = 64, seed=42,
+                       cache=False, shuffle_buffer=1024, target_size=(256, 256), manifest_path=None, stats_path=None):
+    """
+        Builds and returns tf.data pipelines for the same folders and config as GetDataGenerators.
+
+        Please note:
+        > Files are decoded in parallel, batched, augmented on parallel tf.data workers and prefetched, so the GPU does not wait on Python.
+        > Every image and its mask are paired by file name. Each sample gets one random transform, applied to the whole batch of images and of masks at once,
+          so both always move together. Masks use nearest neighbour interpolation, are binarized to 0 and 1 and have one channel.
+        > The validation set is the first "validation_split" of the sorted training files, like the 'validation' subset of flow_from_directory. The Test dataset is not randomly transformed.
+        > featurewise_center, featurewise_std_normalization and zca_whitening use the statistics of stats_path, like PairedAugmenter.
+        > The datasets are finite, one pass is one epoch.
+
+        Parameters
+        ----------
+        >augmentation_parameters (Object of ConfigParser SectionProxy): Configurations from for Augmentation.
+        >train_images_path (str): Path to the parent folder of the folder containting Train Images.
+        >train_targets_path (str): Path to the parent folder of the folder containting Train Masks.
+        >test_images_path (str): Path to the parent folder of the folder containting Test Images.
+        >test_targets_path (str): Path to the parent folder of the folder containting Test Masks.
+        >batch_size (int): Desired batch size for the datasets. Default: 64.
+        >seed (int): this number seeds the shuffling and augmentation. Default: 42.
+        >cache (bool or str): Cache the decoded crops in memory (True) or in a file (path). Default: False.
+        >shuffle_buffer (int): Number of decoded crops to shuffle from when cache is used. Default: 1024.
+        >target_size (tuple): Height and width of the crops. Default: (256, 256).
+        >manifest_path (str): Path to the manifest.json of an incremental build. Replaces the four folder paths. Default: None.
+        >stats_path (str): Statistics written by dataset_stats.py, needed by the featurewise options of the config. Default: None.
+
+        Returns
+        ----------
+        > A list which can have some or all of the three tf.data.Datasets - Train dataset, validation dataset, or/and Test dataset.
+    """
+
+    settings = augmentation_settings(augmentation_parameters)
+    featurewise = featurewise_steps(settings, load_stats(stats_path) if stats_path else None)
+    datasets = []
+    train_pairs, test_pairs = image_pair_lists(train_images_path, train_targets_path, test_images_path, test_targets_path, manifest_path)
+
+    if train_pairs:
+        validation_set_size = int(float(augmentation_parameters["validation_split"]) * len(train_pairs))
+
+        datasets.append(_build_dataset(train_pairs[validation_set_size:], settings, featurewise, batch_size, seed, True, cache, shuffle_buffer, target_size))
+        datasets.append(_build_dataset(train_pairs[:validation_set_size], settings, featurewise, batch_size, seed, True, cache, shuffle_buffer, target_size))
+
+    if test_pairs:
+        datasets.append(_build_dataset(test_pairs, settings, featurewise, batch_size, seed, False, cache, shuffle_buffer, target_size))
+
+    if datasets:
+        return datasets
     else:
         print("Invalid Input for Data Paths. Plese Check and Retry.")
-        return None
\ No newline at end of file
+        return None
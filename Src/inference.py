@@ -1,48 +1,403 @@
-# Imports 
+# Imports
+import threading
+import time
+
 import numpy as np
 
-from tensorflow.keras.models import load_model
-from loss_functions import dice_coef as dice_coef_loss, iou_coef, soft_dice_loss
-from tensorflow.keras.preprocessing.image import load_img
-from skimage import transform
-from PIL import Image
+from postprocessing import clean_up_predictions, encode_mask, threshold_batch
+from tile_filters import BackgroundFilter
+from prediction_cache import CachedModel, PredictionCache, file_fingerprint, weights_fingerprint
+
+# TensorFlow, skimage, PIL and OpenCV are imported by the functions that use them, so the tiling and
+# post-processing code can be imported without paying for them.
 
 # Global Variables
 IMG_HEIGHT, IMG_WIDTH, CHANNELS = 256, 256, 3
-ORIG_HEIGHT, ORIG_WIDTH = 0, 0
+MODEL_PATH = "./Models/road_mapper_final.h5"
 
-# Gives a tensor of size (1, IMG_HEIGHT, IMG_WIDTH, CHANNELS)
-def image_makeup(img_filepath):
-    np_img = load_img(img_filepath)
-    global ORIG_HEIGHT, ORIG_WIDTH
-    ORIG_HEIGHT, ORIG_WIDTH = np_img.size
-    np_img = np.array(np_img).astype('float32') 
-    np_img = transform.resize(np_img, (256, 256, 3))
-    np_img = np.expand_dims(np_img, axis=0)
-    return np_img
-
-def clean_up_predictions(preds) -> list:
-    threshold = 0.05
-    preds = 255 * (preds > threshold).astype('uint8')
-    imgs = []
-    for i in range(len(preds)):
-        image = np.squeeze(preds[i][:, :, 0])
-        image = Image.fromarray(image)
-        image = image.resize((ORIG_HEIGHT, ORIG_WIDTH))
-        imgs.append(image)
-
-def predict(img_path) -> list:
-    model = load_model("./Models/road_mapper_final.h5", custom_objects = {
+# Shared predictors, one per model file. See get_predictor.
+_PREDICTORS = {}
+_PREDICTORS_LOCK = threading.Lock()
+
+# Custom objects the saved model was compiled with.
+def custom_objects():
+    from loss_functions import dice_coef as dice_coef_loss, iou_coef, soft_dice_loss
+    return {
         "soft_dice_loss" : soft_dice_loss,
         "iou_coef" : iou_coef,
         "dice_coef_loss" : dice_coef_loss,
         "dice_loss" : dice_coef_loss,
-    })
+    }
+
+# Reads an image as RGB, like keras.preprocessing.image.load_img.
+def load_img(path):
+    from PIL import Image
+    img = Image.open(path)
+    return img if img.mode == "RGB" else img.convert("RGB")
+
+def open_scene(path):
+    """
+    Opens a scene for predict_tiled without decoding it whole whenever the file allows it.
+
+    Please note:
+    > .npy files and uncompressed, untiled TIFFs are memory-mapped, so only the windows being predicted are read from disk.
+      Convert multi-gigapixel orthomosaics to one of these before predicting them.
+    > Other TIFFs are decoded whole with tifffile, and other formats with OpenCV, which accepts scenes of up to 2^30 pixels
+      where PIL refuses anything above about 179 million.
+    > TIFFs are decoded whole with OpenCV as well when tifffile is not installed or lacks the codec of their compression.
+
+    Returns
+    ----------
+    > An array or np.memmap of shape (height, width, CHANNELS) in RGB order.
+    """
+
+    extension = path.lower().rsplit('.', 1)[-1]
+    scene = None
+    if extension == 'npy':
+        scene = np.load(path, mmap_mode='r')
+    elif extension in ('tif', 'tiff'):
+        try:
+            import tifffile
+            try:
+                scene = tifffile.memmap(path, mode='r')
+            except ValueError:
+                scene = tifffile.imread(path)
+        except (ImportError, ValueError):
+            # Compressed with a codec tifffile needs imagecodecs for, or no tifffile at all.
+            pass
+
+    if scene is None:
+        import cv2
+        scene = cv2.imread(path, cv2.IMREAD_COLOR)
+        if scene is None:
+            raise ValueError("Could not read scene: {}".format(path))
+        scene = scene[..., ::-1]
+
+    # Views only, a memory-mapped scene stays on disk.
+    if scene.ndim == 2:
+        return np.broadcast_to(scene[..., np.newaxis], scene.shape + (CHANNELS,))
+    return scene[..., :CHANNELS]
+
+# Gives a tensor of size (IMG_HEIGHT, IMG_WIDTH, CHANNELS) and the original (width, height).
+# Accepts a path or an array.
+def prepare_image(img):
+    from skimage import transform
+    if isinstance(img, str):
+        img = load_img(img)
+    np_img = np.asarray(img).astype('float32')
+    size = (np_img.shape[1], np_img.shape[0])
+    np_img = transform.resize(np_img, (IMG_HEIGHT, IMG_WIDTH, CHANNELS))
+    return np_img, size
+
+# Gives a tensor of size (1, IMG_HEIGHT, IMG_WIDTH, CHANNELS)
+def image_makeup(img_filepath):
+    np_img, _ = prepare_image(img_filepath)
+    return np.expand_dims(np_img, axis=0)
+
+# Start positions of the windows along one axis. The last window is snapped to
+# the border so the scene is covered without padding whenever it is large enough.
+def tile_origins(length, tile_size, stride) -> list:
+    if length <= tile_size:
+        return [0]
+    origins = list(range(0, length - tile_size, stride))
+    origins.append(length - tile_size)
+    return origins
+
+def blend_window(tile_size, blend="hann"):
+    """
+    Weights used to blend overlapping windows back into one probability map.
+    The borders of a window get less weight than its centre, where the model has the most context.
+
+    Parameters
+    ----------
+    >tile_size (int): Height and width of a window.
+    >blend (str): One of "hann", "triangular" or "uniform". Default: "hann".
+
+    Returns
+    ----------
+    > A float32 array of shape (tile_size, tile_size). Every weight is strictly positive.
+    """
+
+    if blend == "hann":
+        ramp = np.hanning(tile_size + 2)[1:-1]
+    elif blend == "triangular":
+        ramp = 1 - np.abs(np.linspace(-1, 1, tile_size + 2)[1:-1])
+    elif blend == "uniform":
+        ramp = np.ones(tile_size)
+    else:
+        raise ValueError("Unknown blend window: {}".format(blend))
+    return np.outer(ramp, ramp).astype('float32')
+
+def predict_tiled(model, scene, tile_size=IMG_HEIGHT, overlap=32, batch_size=32, blend="hann", out=None,
+                  background_filter=None, fill_value=0., stats=None):
+    """
+    Runs the model over a scene of any size with overlapping tile_size x tile_size windows, at native resolution.
+
+    Please note:
+    > Windows are predicted in batches of batch_size and blended into a rolling buffer that only spans the rows of
+      the current band of windows. Finished rows are flushed to out, so the working memory does not grow with the
+      height of the scene. Pass a memory-mapped scene, see open_scene, and a path as out to process scenes that do not fit in RAM.
+    > Pixels are fed to the model as float32 in the 0-255 range, the same way image_makeup does.
+    > With a background_filter, windows it flags as nodata or uniform are not sent to the model and predict fill_value instead.
+      They are still blended, so the seams with their neighbours stay smooth.
+
+    Parameters
+    ----------
+    >model (keras Model): Trained segmentation model.
+    >scene (numpy array): Image of shape (height, width, CHANNELS).
+    >tile_size (int): Size of the windows fed to the model. Default: 256.
+    >overlap (int): Number of pixels shared by neighbouring windows. Default: 32.
+    >batch_size (int): Number of windows per call to model.predict. Default: 32.
+    >blend (str or numpy array): Name of a blend_window, or a custom (tile_size, tile_size) weight array. Default: "hann".
+    >out (str or numpy array): Optional float32 array of shape (height, width) to write the result to, or the path of a .npy file
+      to create as a np.memmap of that shape.
+    >background_filter (tile_filters.BackgroundFilter): Optional filter of the windows to skip. Default: None.
+    >fill_value (float): Probability of the skipped windows. Default: 0.
+    >stats (dict): Optional dictionary that receives the number of windows ("tiles") and of skipped windows ("skipped"), the seconds spent
+      in the model ("predict_seconds") and in the filter ("precheck_seconds"), and the estimated seconds saved ("seconds_saved").
+
+    Returns
+    ----------
+    > A float32 probability map of shape (height, width).
+    """
+
+    height, width = scene.shape[:2]
+    stride = tile_size - overlap
+    if overlap < 0 or stride <= 0:
+        raise ValueError("overlap must be in [0, {})".format(tile_size))
+
+    window = blend if isinstance(blend, np.ndarray) else blend_window(tile_size, blend)
+    rows = tile_origins(height, tile_size, stride)
+    cols = tile_origins(width, tile_size, stride)
+    if out is None:
+        out = np.empty((height, width), dtype='float32')
+    elif isinstance(out, str):
+        out = np.lib.format.open_memmap(out, mode='w+', dtype='float32', shape=(height, width))
+
+    # Enough rows of windows per band to fill at least one batch.
+    band = max(1, -(-batch_size // len(cols)))
+    buffer_height = (band - 1) * stride + tile_size
+    acc = np.zeros((buffer_height, width), dtype='float32')
+    weights = np.zeros((buffer_height, width), dtype='float32')
+    batch = np.zeros((batch_size, tile_size, tile_size, CHANNELS), dtype='float32')
+    num_tiles = num_skipped = 0
+    predict_seconds = precheck_seconds = 0.
+
+    for b in range(0, len(rows), band):
+        band_rows = rows[b:b + band]
+        top = band_rows[0]
+        coords = [(r, c) for r in band_rows for c in cols]
+
+        for start in range(0, len(coords), batch_size):
+            chunk = coords[start:start + batch_size]
+            for k, (r, c) in enumerate(chunk):
+                tile = scene[r:r + tile_size, c:c + tile_size]
+                batch[k] = 0
+                batch[k, :tile.shape[0], :tile.shape[1]] = tile
+
+            num_tiles += len(chunk)
+            if background_filter is None:
+                start_time = time.perf_counter()
+                preds = model.predict(batch[:len(chunk)], batch_size=len(chunk))[..., 0]
+                predict_seconds += time.perf_counter() - start_time
+            else:
+                start_time = time.perf_counter()
+                foreground = ~background_filter(batch[:len(chunk)])
+                precheck_seconds += time.perf_counter() - start_time
+
+                preds = np.full((len(chunk), tile_size, tile_size), fill_value, dtype='float32')
+                num_skipped += len(chunk) - int(np.count_nonzero(foreground))
+                if foreground.any():
+                    start_time = time.perf_counter()
+                    preds[foreground] = model.predict(batch[:len(chunk)][foreground], batch_size=len(chunk))[..., 0]
+                    predict_seconds += time.perf_counter() - start_time
+
+            for k, (r, c) in enumerate(chunk):
+                h, w = min(tile_size, height - r), min(tile_size, width - c)
+                y = r - top
+                acc[y:y + h, c:c + w] += preds[k, :h, :w] * window[:h, :w]
+                weights[y:y + h, c:c + w] += window[:h, :w]
+
+        # Rows above the next band will not receive any more windows.
+        next_top = rows[b + band] if b + band < len(rows) else height
+        done = next_top - top
+        out[top:next_top] = acc[:done] / weights[:done]
+
+        acc[:buffer_height - done] = acc[done:]
+        acc[buffer_height - done:] = 0
+        weights[:buffer_height - done] = weights[done:]
+        weights[buffer_height - done:] = 0
+
+    if isinstance(out, np.memmap):
+        out.flush()
+
+    if stats is not None:
+        # The time saved is estimated from the average time per window sent to the model.
+        seconds_per_tile = predict_seconds / max(num_tiles - num_skipped, 1)
+        stats.update({"tiles": num_tiles, "skipped": num_skipped, "predict_seconds": predict_seconds, "precheck_seconds": precheck_seconds,
+                      "seconds_saved": num_skipped * seconds_per_tile - precheck_seconds})
+    return out
+
+class _SynchronizedModel:
+    # Serialises calls to model.predict, Keras models are not safe to call from several threads at once.
+    def __init__(self, model, lock):
+        self.model = model
+        self.lock = lock
+
+    def predict(self, *args, **kwargs):
+        with self.lock:
+            return self.model.predict(*args, **kwargs)
+
+class TFLiteModel:
+    """
+    Runs a model exported by export_model.py with the TensorFlow Lite interpreter, behind the predict method of a Keras model.
+
+    Please note:
+    > The interpreter is resized whenever the batch size changes, keep batch_size fixed to avoid reallocating.
+    > Quantized models keep float32 inputs and outputs, so images are prepared exactly as for the Keras model.
+
+    Parameters
+    ----------
+    >model_path (str): Path to the .tflite file.
+    >num_threads (int): Number of CPU threads of the interpreter. Default: None, chosen by TensorFlow Lite.
+    """
+
+    def __init__(self, model_path, num_threads=None):
+        # The standalone LiteRT interpreter replaces tf.lite.Interpreter in recent TensorFlow releases.
+        try:
+            from ai_edge_litert.interpreter import Interpreter
+        except ImportError:
+            import tensorflow as tf
+            Interpreter = tf.lite.Interpreter
+        self.interpreter = Interpreter(model_path=model_path, num_threads=num_threads)
+        self.input_index = self.interpreter.get_input_details()[0]["index"]
+        self.output_index = self.interpreter.get_output_details()[0]["index"]
+        self.input_shape = None
+
+    def predict(self, batch, batch_size=32, **kwargs):
+        batch = np.asarray(batch, dtype='float32')
+        preds = []
+
+        for start in range(0, len(batch), batch_size):
+            chunk = batch[start:start + batch_size]
+            if chunk.shape != self.input_shape:
+                self.interpreter.resize_tensor_input(self.input_index, chunk.shape)
+                self.interpreter.allocate_tensors()
+                self.input_shape = chunk.shape
+
+            self.interpreter.set_tensor(self.input_index, chunk)
+            self.interpreter.invoke()
+            preds.append(self.interpreter.get_tensor(self.output_index).copy())
+
+        return np.concatenate(preds)
+
+# Loads a Keras model, or a TensorFlow Lite export of it when the path ends with .tflite.
+def load_serving_model(model_path):
+    if model_path.endswith('.tflite'):
+        return TFLiteModel(model_path)
+    from tensorflow.keras.models import load_model
+    return load_model(model_path, custom_objects=custom_objects())
+
+class Predictor:
+    """
+    Loads the model once and serves any number of predictions with it.
+
+    Please note:
+    > Calls to the model are guarded by a lock, so one Predictor can be shared by several threads. Use get_predictor
+      to get the shared instance of a model file.
+    > With a cache_path, predictions are cached on disk by the content of every input image or window, and only the inputs
+      never seen by this model are predicted. See prediction_cache.PredictionCache, its counters are in predictor.cache.stats().
+
+    Parameters
+    ----------
+    >model_path (str): Path to the saved model, a Keras file or a .tflite export. Default: MODEL_PATH.
+    >model (keras Model): Already loaded model to use instead of model_path.
+    >warmup (bool): Run one dummy batch so the first real call does not pay for building the predict function. Default: True.
+    >cache_path (str): Optional SQLite file of a prediction cache. Default: None, no cache.
+    >cache_size (int): Maximum size of the cache in bytes. Default: 1 GB.
+
+    Example
+    ----------
+    > predictor = Predictor()
+      masks = predictor.predict(["a.tiff", "b.tiff"])
+    """
+
+    def __init__(self, model_path=MODEL_PATH, model=None, warmup=True, cache_path=None, cache_size=1 << 30):
+        self.model_path = model_path
+        self.model = model if model is not None else load_serving_model(model_path)
+        self._synchronized = _SynchronizedModel(self.model, threading.Lock())
+
+        self.cache = None
+        self._runner = self._synchronized
+        if cache_path is not None:
+            fingerprint = weights_fingerprint(model) if model is not None else file_fingerprint(model_path)
+            self.cache = PredictionCache(cache_path, fingerprint, cache_size)
+            self._runner = CachedModel(self._synchronized, self.cache)
+
+        if warmup:
+            self._synchronized.predict(np.zeros((1, IMG_HEIGHT, IMG_WIDTH, CHANNELS), dtype='float32'))
+
+    def predict(self, images, batch_size=32, output_format="image") -> list:
+        """
+        Predicts the masks of one or more images with a single call to model.predict.
+
+        Parameters
+        ----------
+        >images (str, numpy array or list of them): Paths to images, or images of shape (height, width, CHANNELS).
+        >batch_size (int): Batch size passed on to model.predict. Default: 32.
+        >output_format (str): How the masks are returned, see postprocessing.encode_mask. Default: "image".
+
+        Returns
+        ----------
+        > A list with one mask per input, at the size of the input. PIL Images by default.
+        """
+
+        if isinstance(images, (str, np.ndarray)):
+            images = [images]
+
+        prepared = [prepare_image(img) for img in images]
+        batch = np.stack([np_img for np_img, _ in prepared])
+        sizes = [size for _, size in prepared]
+
+        return clean_up_predictions(self.predict_batch(batch, batch_size), sizes, output_format=output_format)
+
+    def predict_batch(self, batch, batch_size=32):
+        """
+        Raw probabilities for a batch of images already prepared with prepare_image, of shape (n, IMG_HEIGHT, IMG_WIDTH, CHANNELS).
+        """
+
+        return self._runner.predict(batch, batch_size=batch_size)
+
+    def predict_tiled(self, scene, **kwargs):
+        """
+        Full resolution probability map of a scene, see predict_tiled for the keyword arguments.
+        A path is opened with open_scene, so memory-mapped scenes are read window by window.
+        """
 
-    preds = model.predict(image_makeup(img_path))
-    imgs_list = clean_up_predictions(preds)
-    return imgs_list 
+        if isinstance(scene, str):
+            scene = open_scene(scene)
+        return predict_tiled(self._runner, scene, **kwargs)
 
+def get_predictor(model_path=MODEL_PATH, cache_path=None) -> Predictor:
+    # One Predictor per model file, prediction cache and process, created on first use.
+    with _PREDICTORS_LOCK:
+        if (model_path, cache_path) not in _PREDICTORS:
+            _PREDICTORS[(model_path, cache_path)] = Predictor(model_path, cache_path=cache_path)
+        return _PREDICTORS[(model_path, cache_path)]
 
+def predict(img_path, tiled=False, overlap=32, batch_size=32, blend="hann", output_format="image", skip_background=False, cache_path=None, out=None) -> list:
+    # cache_path reuses the predictions of inputs already seen, see Predictor.
+    predictor = get_predictor(cache_path=cache_path)
 
+    # Full resolution mask of the whole scene, instead of a 256x256 thumbnail.
+    # skip_background leaves the nodata and uniform windows out of the model, see tile_filters.BackgroundFilter.
+    # With out, the probabilities are written to that .npy file and returned as a np.memmap instead of being encoded,
+    # which would need the whole mask in memory.
+    if tiled:
+        background_filter = BackgroundFilter() if skip_background else None
+        probabilities = predictor.predict_tiled(img_path, overlap=overlap, batch_size=batch_size, blend=blend, background_filter=background_filter, out=out)
+        if out is not None:
+            return [probabilities]
+        return [encode_mask(threshold_batch(probabilities[np.newaxis])[0], output_format)]
 
+    return predictor.predict(img_path, output_format=output_format)
@@ -6,5 +6,10 @@ def dice_coef(y_true, y_pred, smooth = 1):
     intersection = K.sum(y_true_f * y_pred_f)
     return (2. * intersection + smooth) / (K.sum(y_true_f) + K.sum(y_pred_f) + smooth)
 
+def iou_coef(y_true, y_pred, smooth = 1):
+    intersection = K.sum(K.abs(y_true * y_pred), axis=[1,2,3])
+    union = K.sum(y_true,[1,2,3])+K.sum(y_pred,[1,2,3])-intersection
+    return K.mean((intersection + smooth) / (union + smooth), axis=0)
+
 def soft_dice_loss(y_true, y_pred):
-    return 1-dice_coef(y_true, y_pred)
\ No newline at end of file
+    return 1-dice_coef(y_true, y_pred)
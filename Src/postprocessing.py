@@ -0,0 +1,173 @@
+"""
+Filename: postprocessing.py
+
+Function: Turns batches of predicted probabilities into binary road masks at the size of the original images, and encodes them compactly for downstream services.
+Only NumPy is imported up front, OpenCV and PIL are loaded by the encoders that need them.
+
+Author: Jerin Paul (https://github.com/Paulymorphous)
+Website: https://www.livetheaiexperience.com/
+"""
+
+import numpy as np
+
+THRESHOLD = 0.05
+OUTPUT_FORMATS = ("image", "array", "packed", "rle", "polygons")
+
+
+def threshold_batch(preds, threshold=THRESHOLD):
+    """
+    Thresholds a batch of predictions of shape (n, height, width) or (n, height, width, 1) into uint8 masks with roads at 255.
+    """
+
+    if preds.ndim == 4:
+        preds = preds[..., 0]
+    return (preds > threshold).astype(np.uint8) * 255
+
+
+def upsample_masks(masks, sizes):
+    """
+    Resizes a batch of masks to the size of their original images with nearest neighbour sampling, so they stay binary.
+
+    Please note:
+    > Masks that go to the same size are resized together with one gather.
+
+    Parameters
+    ----------
+    >masks (numpy array): Masks of shape (n, height, width).
+    >sizes (list): (width, height) of the original image of every mask.
+
+    Returns
+    ----------
+    > A list of n uint8 arrays of shape (original height, original width).
+    """
+
+    height, width = masks.shape[1:3]
+    upsampled = [None] * len(masks)
+
+    for size in set(tuple(size) for size in sizes):
+        selected = [n for n, mask_size in enumerate(sizes) if tuple(mask_size) == size]
+        target_width, target_height = size
+        rows = np.minimum(((np.arange(target_height) + 0.5) * height / target_height).astype(np.intp), height - 1)
+        cols = np.minimum(((np.arange(target_width) + 0.5) * width / target_width).astype(np.intp), width - 1)
+        resized = masks[selected][:, rows[:, np.newaxis], cols]
+        for n, mask in zip(selected, resized):
+            upsampled[n] = mask
+
+    return upsampled
+
+
+def pack_mask(mask):
+    """
+    Packs a mask into one bit per pixel, 8 times smaller than the uint8 mask.
+
+    Returns
+    ----------
+    > A dictionary with the "shape" of the mask and the "bits" array from np.packbits, row by row.
+    """
+
+    return {"shape": mask.shape, "bits": np.packbits(mask > 0, axis=-1)}
+
+
+def unpack_mask(packed):
+    height, width = packed["shape"]
+    return np.unpackbits(packed["bits"], axis=-1, count=width).astype(np.uint8) * 255
+
+
+def rle_encode(mask):
+    """
+    Run-length encodes the road pixels of a mask.
+
+    Returns
+    ----------
+    > A dictionary with the "size" [height, width] of the mask and "counts", alternating start and length of every run of road pixels,
+      with starts counted from 0 in row-major order.
+    """
+
+    flat = np.concatenate([[False], mask.ravel() > 0, [False]])
+    changes = np.flatnonzero(flat[1:] != flat[:-1])
+    starts, ends = changes[0::2], changes[1::2]
+    counts = np.empty(2 * len(starts), dtype=np.int64)
+    counts[0::2], counts[1::2] = starts, ends - starts
+    return {"size": list(mask.shape), "counts": counts.tolist()}
+
+
+def rle_decode(rle):
+    height, width = rle["size"]
+    counts = np.asarray(rle["counts"], dtype=np.int64)
+    boundaries = np.zeros(height * width + 1, dtype=np.int8)
+    np.add.at(boundaries, counts[0::2], 1)
+    np.add.at(boundaries, counts[0::2] + counts[1::2], -1)
+    return (np.cumsum(boundaries[:-1]) > 0).astype(np.uint8).reshape(height, width) * 255
+
+
+def mask_to_polygons(mask, epsilon=1.0):
+    """
+    Vectorizes a mask into polygons with OpenCV contours simplified by Douglas-Peucker.
+
+    Parameters
+    ----------
+    >mask (numpy array): uint8 mask.
+    >epsilon (float): Maximum distance, in pixels, between a contour and its simplified polygon. Default: 1.0.
+
+    Returns
+    ----------
+    > A list of polygons, each a dictionary with an "exterior" ring and a list of "holes", as lists of [x, y] points.
+    """
+
+    import cv2
+
+    contours, hierarchy = cv2.findContours((mask > 0).astype(np.uint8), cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE)[-2:]
+    if hierarchy is None:
+        return []
+
+    def ring(contour):
+        return cv2.approxPolyDP(contour, epsilon, True)[:, 0, :].tolist()
+
+    # With RETR_CCOMP the outer boundaries have no parent, and the holes point at their outer boundary.
+    polygons = {}
+    for n, (_, _, _, parent) in enumerate(hierarchy[0]):
+        if parent < 0:
+            polygons[n] = {"exterior": ring(contours[n]), "holes": []}
+    for n, (_, _, _, parent) in enumerate(hierarchy[0]):
+        if parent >= 0:
+            polygons[parent]["holes"].append(ring(contours[n]))
+    return list(polygons.values())
+
+
+def encode_mask(mask, output_format="image"):
+    """
+    Encodes one uint8 mask as a PIL Image ("image"), the array itself ("array"), packed bits ("packed"), run-lengths ("rle") or polygons ("polygons").
+    """
+
+    if output_format == "image":
+        from PIL import Image
+        return Image.fromarray(mask)
+    if output_format == "array":
+        return mask
+    if output_format == "packed":
+        return pack_mask(mask)
+    if output_format == "rle":
+        return rle_encode(mask)
+    if output_format == "polygons":
+        return mask_to_polygons(mask)
+    raise ValueError("Unknown output format: {}, expected one of {}".format(output_format, OUTPUT_FORMATS))
+
+
+def clean_up_predictions(preds, sizes, threshold=THRESHOLD, output_format="image") -> list:
+    """
+    Thresholds a batch of predictions, brings every mask back to the size of its original image and encodes it.
+
+    Parameters
+    ----------
+    >preds (numpy array): Model output of shape (n, height, width, 1).
+    >sizes (list): (width, height) of the original image of every prediction.
+    >threshold (float): Probability above which a pixel is a road. Default: 0.05.
+    >output_format (str): One of OUTPUT_FORMATS, see encode_mask. Default: "image".
+
+    Returns
+    ----------
+    > A list with one encoded mask per prediction.
+    """
+
+    masks = upsample_masks(threshold_batch(preds, threshold), sizes)
+    return [encode_mask(mask, output_format) for mask in masks]
@@ -0,0 +1,208 @@
+"""
+Filename: prediction_cache.py
+
+Function: On-disk cache of model predictions keyed by the pixels of the input tile and a fingerprint of the model, so re-running inference on a partly updated mosaic only predicts the tiles that changed.
+
+Author: Jerin Paul (https://github.com/Paulymorphous)
+Website: https://www.livetheaiexperience.com/
+"""
+
+import hashlib
+import sqlite3
+import threading
+import time
+import zlib
+
+import numpy as np
+
+
+def file_fingerprint(path):
+    """
+    sha256 of the bytes of a saved model. Retraining or re-exporting the model changes it, which invalidates the cached predictions.
+    """
+
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as model_file:
+        for chunk in iter(lambda: model_file.read(1 << 20), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def weights_fingerprint(model):
+    # sha256 of the weights of an in-memory Keras model.
+    hasher = hashlib.sha256()
+    for weights in model.get_weights():
+        hasher.update(np.ascontiguousarray(weights).tobytes())
+    return hasher.hexdigest()
+
+
+class PredictionCache:
+    """
+    Stores the probability map of every tile the model has seen in a SQLite file, and evicts the least recently used ones beyond max_bytes.
+
+    Please note:
+    > The key of a tile is a sha256 of the model fingerprint and the bytes, shape and dtype of the tile, so a single changed pixel is a miss.
+    > Probabilities are stored as uint8 levels compressed with zlib, a few KB per 256x256 tile. Cached values are therefore rounded to 1/255.
+    > One cache can be shared by several threads, and by several processes through the SQLite file.
+    > The bytes stored are kept as a running total in the file, so a put costs the same however large the cache is.
+
+    Parameters
+    ----------
+    >path (str): Path to the SQLite file, created if needed.
+    >fingerprint (str): Fingerprint of the model, see file_fingerprint and weights_fingerprint.
+    >max_bytes (int): Maximum size of the stored predictions. Default: 1 GB.
+
+    Example
+    ----------
+    > predictor = Predictor(MODEL_PATH, cache_path="predictions.sqlite", cache_size=1 << 30)
+      print(predictor.cache.stats())
+    """
+
+    def __init__(self, path, fingerprint, max_bytes=1 << 30):
+        self.path = path
+        self.fingerprint = fingerprint.encode()
+        self.max_bytes = max_bytes
+        self.hits = self.misses = self.evictions = 0
+        self.lock = threading.Lock()
+
+        self.connection = sqlite3.connect(path, check_same_thread=False, timeout=60)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS predictions (key BLOB PRIMARY KEY, height INTEGER, width INTEGER, data BLOB, size INTEGER, last_used REAL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS predictions_last_used ON predictions (last_used)")
+        # One row with the total size of the predictions, counted once when the table is created or predates it.
+        self.connection.execute("CREATE TABLE IF NOT EXISTS usage (id INTEGER PRIMARY KEY CHECK (id = 0), bytes INTEGER)")
+        self.connection.execute("INSERT OR IGNORE INTO usage SELECT 0, COALESCE(SUM(size), 0) FROM predictions")
+        # The file may have been filled under a larger max_bytes.
+        self._evict()
+        self.connection.commit()
+
+    def keys(self, tiles):
+        keys = []
+        for tile in tiles:
+            hasher = hashlib.sha256(self.fingerprint)
+            hasher.update("{}{}".format(tile.shape, tile.dtype).encode())
+            hasher.update(np.ascontiguousarray(tile).tobytes())
+            keys.append(hasher.digest())
+        return keys
+
+    def get(self, keys):
+        """
+        Looks up a batch of keys and marks the ones found as recently used.
+
+        Returns
+        ----------
+        > A list with a float32 probability map of shape (height, width) per key, or None for a miss.
+        """
+
+        with self.lock:
+            rows = {}
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                query = "SELECT key, height, width, data FROM predictions WHERE key IN ({})".format(",".join("?" * len(chunk)))
+                for key, height, width, data in self.connection.execute(query, chunk):
+                    rows[key] = (height, width, data)
+
+            if rows:
+                now = time.time()
+                self.connection.executemany("UPDATE predictions SET last_used = ? WHERE key = ?", [(now, key) for key in rows])
+                self.connection.commit()
+
+            self.hits += len(rows)
+            self.misses += len(keys) - len(rows)
+
+        results = []
+        for key in keys:
+            if key in rows:
+                height, width, data = rows[key]
+                results.append(np.frombuffer(zlib.decompress(data), dtype=np.uint8).reshape(height, width).astype(np.float32) / 255)
+            else:
+                results.append(None)
+        return results
+
+    def put(self, keys, preds):
+        """
+        Stores the probability maps of shape (height, width) of a batch of keys, then evicts the least recently used entries above max_bytes.
+        """
+
+        now = time.time()
+        rows = []
+        for key, pred in zip(keys, preds):
+            data = zlib.compress(np.rint(np.clip(pred, 0, 1) * 255).astype(np.uint8).tobytes(), 1)
+            rows.append((key, pred.shape[0], pred.shape[1], data, len(data), now))
+
+        with self.lock:
+            # Taken at once, so no other process changes the rows between the lookup of the replaced sizes and the insert.
+            self.connection.execute("BEGIN IMMEDIATE")
+            replaced = 0
+            for start in range(0, len(rows), 500):
+                chunk = [row[0] for row in rows[start:start + 500]]
+                query = "SELECT COALESCE(SUM(size), 0) FROM predictions WHERE key IN ({})".format(",".join("?" * len(chunk)))
+                replaced += self.connection.execute(query, chunk).fetchone()[0]
+
+            self.connection.executemany("INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self.connection.execute("UPDATE usage SET bytes = bytes + ?", (sum(row[4] for row in rows) - replaced,))
+            self._evict()
+            self.connection.commit()
+
+    def _evict(self):
+        excess = self.connection.execute("SELECT bytes FROM usage").fetchone()[0] - self.max_bytes
+        if excess <= 0:
+            return
+
+        evicted, evicted_bytes = [], 0
+        for key, size in self.connection.execute("SELECT key, size FROM predictions ORDER BY last_used"):
+            evicted.append((key,))
+            evicted_bytes += size
+            if evicted_bytes >= excess:
+                break
+        self.connection.executemany("DELETE FROM predictions WHERE key = ?", evicted)
+        self.connection.execute("UPDATE usage SET bytes = bytes - ?", (evicted_bytes,))
+        self.evictions += len(evicted)
+
+    def stats(self):
+        """
+        Returns
+        ----------
+        > A dictionary with the hits, misses and evictions of this instance, its hit rate, and the number of entries and bytes stored.
+        """
+
+        with self.lock:
+            entries = self.connection.execute("SELECT COUNT(*) FROM predictions").fetchone()[0]
+            size = self.connection.execute("SELECT bytes FROM usage").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.,
+                "evictions": self.evictions, "entries": entries, "bytes": size}
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class CachedModel:
+    """
+    Wraps a model so that predict only runs it on the samples missing from a PredictionCache, and stores their results.
+
+    Please note:
+    > Has the predict method of a Keras model with a single channel output, so it can be used by inference.predict_tiled and inference.Predictor.
+    > Fresh predictions are rounded like cached ones, so a re-run returns exactly what the first run did.
+    """
+
+    def __init__(self, model, cache):
+        self.model = model
+        self.cache = cache
+
+    def predict(self, batch, batch_size=32, **kwargs):
+        keys = self.cache.keys(batch)
+        cached = self.cache.get(keys)
+        missing = [n for n, pred in enumerate(cached) if pred is None]
+
+        preds = np.empty(batch.shape[:3] + (1,), dtype=np.float32)
+        for n, pred in enumerate(cached):
+            if pred is not None:
+                preds[n, ..., 0] = pred
+
+        if missing:
+            computed = self.model.predict(batch[missing], batch_size=batch_size, **kwargs)
+            self.cache.put([keys[n] for n in missing], computed[..., 0])
+            preds[missing] = np.rint(np.clip(computed, 0, 1) * 255) / 255
+        return preds
@@ -0,0 +1,194 @@
+"""
+Filename: shards.py
+
+Function: Packs the cropped images and masks into a few large uint8 arrays instead of one file per crop, and reads them back through memory maps.
+
+Author: Jerin Paul (https://github.com/Paulymorphous)
+Website: https://www.livetheaiexperience.com/
+"""
+
+import json
+import os
+import numpy as np
+
+INDEX_FILE = "index.json"
+
+
+class ShardWriter:
+    """
+    Collects crops in memory and writes them out as .npy shards of shard_size crops each.
+
+    Please note:
+    > Every shard is a pair of files, images_<n>.npy of shape (count, height, width, channels) and masks_<n>.npy of shape (count, height, width), both uint8.
+    > Images are stored in RGB order, the order the model is trained and served on. Crops read with OpenCV must be flipped from BGR before add.
+    > index.json lists the shard files and, for every crop, its shard, its offset in the shard, the source image, the row and column of its top left corner in the source image and its fraction of annotated pixels.
+    > The index is only written by close(), a directory without one is an unfinished build.
+
+    Parameters
+    ----------
+    >output_path (str): Directory to write the shards to.
+    >img_width (int): width of the crops.
+    >img_height (int): height of the crops.
+    >channels (int): Number of channels of the images. Default: 3.
+    >shard_size (int): Number of crops per shard. Default: 512.
+    """
+
+    def __init__(self, output_path, img_width, img_height, channels=3, shard_size=512):
+        self.output_path = output_path
+        self.shard_size = shard_size
+        self.images = np.empty((shard_size, img_height, img_width, channels), dtype=np.uint8)
+        self.masks = np.empty((shard_size, img_height, img_width), dtype=np.uint8)
+        self.count = 0
+        self.shards = []
+        self.tiles = {"shard": [], "offset": [], "source": [], "row": [], "col": [], "foreground": []}
+        self.index = {"img_width": img_width, "img_height": img_height, "channels": channels, "channel_order": "RGB"}
+
+        os.makedirs(output_path, exist_ok=True)
+
+    def add(self, source, image_tiles, mask_tiles, rows, cols, fractions):
+        """
+        Adds the crops of one source image.
+
+        Parameters
+        ----------
+        >source (str): File name of the source image.
+        >image_tiles (numpy array): RGB crops of shape (n, height, width, channels).
+        >mask_tiles (numpy array): Masks of shape (n, height, width).
+        >rows, cols (sequences of int): Position of the top left corner of every crop in the source image.
+        >fractions (sequence of float): Fraction of annotated pixels in every crop.
+        """
+
+        for image_tile, mask_tile, row, col, fraction in zip(image_tiles, mask_tiles, rows, cols, fractions):
+            self.images[self.count] = image_tile
+            self.masks[self.count] = mask_tile
+
+            self.tiles["shard"].append(len(self.shards))
+            self.tiles["offset"].append(self.count)
+            self.tiles["source"].append(source)
+            self.tiles["row"].append(int(row))
+            self.tiles["col"].append(int(col))
+            self.tiles["foreground"].append(float(fraction))
+
+            self.count += 1
+            if self.count == self.shard_size:
+                self.flush()
+
+    def flush(self):
+        if not self.count:
+            return
+        shard = {"images": "images_{:05d}.npy".format(len(self.shards)), "masks": "masks_{:05d}.npy".format(len(self.shards)), "count": self.count}
+        np.save(os.path.join(self.output_path, shard["images"]), self.images[:self.count])
+        np.save(os.path.join(self.output_path, shard["masks"]), self.masks[:self.count])
+        self.shards.append(shard)
+        self.count = 0
+
+    def close(self):
+        """
+        Writes the last, partially filled shard and the index.
+
+        Returns
+        ----------
+        > The number of crops written.
+        """
+
+        self.flush()
+        self.index["shards"] = self.shards
+        self.index["tiles"] = self.tiles
+        with open(os.path.join(self.output_path, INDEX_FILE), 'w') as index_file:
+            json.dump(self.index, index_file)
+        return len(self.tiles["shard"])
+
+
+class ShardDataset:
+    """
+    Random access to the crops of a directory written by ShardWriter.
+
+    Please note:
+    > The shards are opened as read-only memory maps, indexing returns views into them and nothing is read until the pixels are used.
+    > Use subset or split to get datasets over part of the crops, they share the same memory maps.
+    > Images are returned in RGB order. Shards written before the index recorded a channel_order hold BGR crops, they are flipped when read.
+
+    Parameters
+    ----------
+    >path (str): Directory with the shards and index.json.
+
+    Example
+    ----------
+    > dataset = ShardDataset("../Data/MassachusettsRoads/Shards/")
+      train_set, test_set = dataset.split(0.3)
+      images, masks = train_set.get_batch([0, 5, 7])
+    """
+
+    def __init__(self, path):
+        with open(os.path.join(path, INDEX_FILE), 'r') as index_file:
+            index = json.load(index_file)
+
+        self.path = path
+        self.img_width, self.img_height, self.channels = index["img_width"], index["img_height"], index["channels"]
+        self.images = [np.load(os.path.join(path, shard["images"]), mmap_mode='r') for shard in index["shards"]]
+        self.masks = [np.load(os.path.join(path, shard["masks"]), mmap_mode='r') for shard in index["shards"]]
+        self.bgr = index.get("channel_order") != "RGB"
+
+        tiles = index["tiles"]
+        self.shard = np.asarray(tiles["shard"], dtype=np.int64)
+        self.offset = np.asarray(tiles["offset"], dtype=np.int64)
+        self.source = np.asarray(tiles["source"])
+        self.row = np.asarray(tiles["row"], dtype=np.int64)
+        self.col = np.asarray(tiles["col"], dtype=np.int64)
+        self.foreground = np.asarray(tiles["foreground"], dtype=np.float64)
+        self.indices = np.arange(len(self.shard))
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, position):
+        tile = self.indices[position]
+        shard, offset = self.shard[tile], self.offset[tile]
+        image = self.images[shard][offset]
+        return image[..., ::-1] if self.bgr else image, self.masks[shard][offset]
+
+    def subset(self, positions):
+        """
+        Dataset over the crops at the given positions of this dataset, without reopening the shards.
+        """
+
+        dataset = object.__new__(ShardDataset)
+        dataset.__dict__.update(self.__dict__)
+        dataset.indices = self.indices[np.asarray(positions, dtype=np.int64)]
+        return dataset
+
+    def split(self, test_split=0.3):
+        """
+        Splits the dataset the way train_test_split does: the first test_split of the crops form the test set.
+
+        Returns
+        ----------
+        > A tuple (train dataset, test dataset).
+        """
+
+        test_set_size = int(test_split * len(self))
+        return self.subset(np.arange(test_set_size, len(self))), self.subset(np.arange(test_set_size))
+
+    def get_batch(self, positions):
+        """
+        Copies the crops at the given positions out of the shards, one fancy index per shard.
+
+        Returns
+        ----------
+        > A tuple (images, masks) of uint8 arrays of shape (n, height, width, channels) and (n, height, width).
+        """
+
+        tiles = self.indices[np.asarray(positions, dtype=np.int64)]
+        images = np.empty((len(tiles), self.img_height, self.img_width, self.channels), dtype=np.uint8)
+        masks = np.empty((len(tiles), self.img_height, self.img_width), dtype=np.uint8)
+
+        shards = self.shard[tiles]
+        for shard in np.unique(shards):
+            selected = shards == shard
+            offsets = self.offset[tiles[selected]]
+            images[selected] = self.images[shard][offsets]
+            masks[selected] = self.masks[shard][offsets]
+
+        if self.bgr:
+            images = images[..., ::-1]
+        return images, masks
@@ -0,0 +1,97 @@
+"""
+Filename: tile_filters.py
+
+Function: Cheap per-tile statistics that flag nodata and uniform tiles, so they can be dropped from the dataset and skipped by the model.
+
+Author: Jerin Paul (https://github.com/Paulymorphous)
+Website: https://www.livetheaiexperience.com/
+"""
+
+import numpy as np
+
+
+def nodata_fraction(tiles, nodata_value=255):
+    """
+    Fraction of the pixels of every tile whose channels all equal nodata_value.
+
+    Parameters
+    ----------
+    >tiles (numpy array): Tiles of shape (n, height, width, channels).
+    >nodata_value (int): Value of the padding. Default: 255, the white borders of the scenes.
+
+    Returns
+    ----------
+    > A float array of shape (n,).
+    """
+
+    return np.all(tiles == nodata_value, axis=-1).mean(axis=(1, 2))
+
+
+def tile_std(tiles):
+    # Standard deviation of all the values of every tile, near 0 for a flat colour.
+    return tiles.reshape(len(tiles), -1).std(axis=1, dtype=np.float32)
+
+
+def histogram_peak(tiles, bins=32):
+    """
+    Fraction of the pixels of every tile that fall in its most common grey level, out of bins levels.
+
+    Please note:
+    > The histograms of all the tiles are counted with a single bincount.
+    """
+
+    num_tiles = len(tiles)
+    levels = np.minimum((tiles.mean(axis=-1) * (bins / 256.)).astype(np.intp), bins - 1)
+    index = levels.reshape(num_tiles, -1) + (np.arange(num_tiles) * bins)[:, np.newaxis]
+    histograms = np.bincount(index.ravel(), minlength=num_tiles * bins).reshape(num_tiles, bins)
+    return histograms.max(axis=1) / levels[0].size if num_tiles else np.zeros(0)
+
+
+class BackgroundFilter:
+    """
+    Flags the tiles that are mostly nodata or carry no texture, so they can be dropped before they are written or skipped before they reach the model.
+
+    Please note:
+    > A tile is background when its nodata fraction reaches max_nodata_fraction, or the standard deviation of its values is below min_std,
+      or, with max_histogram_peak, when one grey level holds at least that fraction of its pixels.
+    > Tiles are uint8 or float in the 0-255 range, as written by build_dataset and fed to the model by inference.
+    > The statistics are computed on every sample_step-th row and column only, which keeps the check far cheaper than the model.
+
+    Parameters
+    ----------
+    >nodata_value (int): Value of the padding. Default: 255.
+    >max_nodata_fraction (float): Nodata fraction from which a tile is background. Default: 0.9.
+    >min_std (float): Standard deviation below which a tile is background. Default: 2.0.
+    >max_histogram_peak (float): Optional histogram test, see histogram_peak. Default: None, not applied.
+    >sample_step (int): Step between the sampled rows and columns. Default: 4.
+
+    Example
+    ----------
+    > background = BackgroundFilter()(tiles)
+      tiles = tiles[~background]
+    """
+
+    def __init__(self, nodata_value=255, max_nodata_fraction=0.9, min_std=2.0, max_histogram_peak=None, sample_step=4):
+        self.nodata_value = nodata_value
+        self.max_nodata_fraction = max_nodata_fraction
+        self.min_std = min_std
+        self.max_histogram_peak = max_histogram_peak
+        self.sample_step = sample_step
+
+    def settings(self):
+        return {"nodata_value": self.nodata_value, "max_nodata_fraction": self.max_nodata_fraction,
+                "min_std": self.min_std, "max_histogram_peak": self.max_histogram_peak, "sample_step": self.sample_step}
+
+    def __call__(self, tiles):
+        """
+        Returns
+        ----------
+        > A boolean array of shape (n,), True for the background tiles.
+        """
+
+        tiles = tiles[:, ::self.sample_step, ::self.sample_step]
+        background = nodata_fraction(tiles, self.nodata_value) >= self.max_nodata_fraction
+        background |= tile_std(tiles) < self.min_std
+        if self.max_histogram_peak is not None:
+            background |= histogram_peak(tiles) >= self.max_histogram_peak
+        return background